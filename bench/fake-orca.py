@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+# -*- coding: utf8 -*-
+
+##########################################################################
+#                                                                        #
+# Program: fake-orca.py                                                  #
+#                                                                        #
+# Usage: fake-orca.py name.inp                                           #
+#                                                                        #
+# Stand-in for Orca (and for the run script in #orcacmd), for testing    #
+# IRC4Orca without Orca: it reads the geometry and the method line of    #
+# name.inp, computes the energy (and, with EnGrad, the gradient) on one  #
+# of the analytic surfaces of IRC4Orca, and writes them to name.out in   #
+# the format of Orca (and an empty name.gbw). The environment variables: #
+#                                                                        #
+#   FAKE_ORCA_SURFACE - mullerbrown (default) or morse                   #
+#   FAKE_ORCA_FAIL    - calculations that fail, as a comma-separated     #
+#                       list of mode@n or mode@n+k (the n-th call, or k  #
+#                       calls from the n-th one, counting from 1):       #
+#                         scf      - the SCF does not converge           #
+#                         crash    - exits with an error, no output      #
+#                         noenergy - the output ends before the energy   #
+#                         hang     - never ends, and writes nothing      #
+#                         stall    - writes part of the output, and then #
+#                                    never ends                          #
+#   FAKE_ORCA_COUNTER - file with the number of calls so far (default:   #
+#                       fake-orca.<pid of the parent>.count in $TMPDIR)  #
+#                                                                        #
+# e.g., for the 3rd calculation to fail twice, and the 10th to hang:     #
+#   FAKE_ORCA_FAIL=scf@3+2,hang@10 irc4orca.py file.inp                  #
+# with "#orcacmd /path/to/bench/fake-orca.py" in file.inp.               #
+#                                                                        #
+##########################################################################
+
+import os
+import sys
+import time
+import fcntl
+import tempfile
+import numpy as np
+
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(here))
+import irc4orca
+
+def countCall():
+	#-> number of this call, from the counter file shared by all calls
+	fname=os.environ.get('FAKE_ORCA_COUNTER',os.path.join(tempfile.gettempdir(),'fake-orca.%d.count'%(os.getppid())))
+	cfile=open(fname,'a+')
+	fcntl.flock(cfile,fcntl.LOCK_EX)
+	cfile.seek(0)
+	data=cfile.read().strip()
+	n=1
+	if (data!=''):
+		n=int(data)+1
+	cfile.seek(0)
+	cfile.truncate()
+	cfile.write("%d\n"%(n))
+	cfile.close()
+	return n
+
+def failureMode(n):
+	#-> the mode in which call n fails, or None
+	for rule in os.environ.get('FAKE_ORCA_FAIL','').split(','):
+		if ('@' not in rule):
+			continue
+		mode,calls=rule.strip().split('@')
+		first,count=(calls+'+1').split('+')[:2]
+		if (int(first)<=n<(int(first)+int(count))):
+			return mode
+	return None
+
+def readInput(fname):
+	#-> lines of the input, keywords (lower case) and geometry
+	lines=open(fname,'r').readlines()
+	keywords=' '.join([l[1:] for l in lines if l.startswith('!')]).lower().split()
+	symbols=[]
+	coords=[]
+	ingeo=False
+	for line in lines:
+		if line.startswith('*'):
+			if ingeo:
+				break
+			ingeo=True
+		elif ingeo and (line.strip()!=''):
+			l=line.split()
+			symbols.append(l[0])
+			coords.append(list(map(float,l[1:4])))
+	return (lines,keywords,irc4orca.Geometry(symbols,coords))
+
+if (__name__=='__main__'):
+	if (len(sys.argv)!=2):
+		print("Usage: fake-orca.py name.inp")
+		sys.exit(1)
+	inpname=sys.argv[1]
+	base=inpname[:-4]
+	mode=failureMode(countCall())
+	if (mode=='crash'):
+		sys.stderr.write("fake-orca: aborting on request (FAKE_ORCA_FAIL)\n")
+		sys.exit(1)
+	if (mode=='hang'):
+		while True:
+			time.sleep(60)
+	lines,keywords,geo=readInput(inpname)
+	surface=irc4orca.BACKENDS[os.environ.get('FAKE_ORCA_SURFACE','mullerbrown')](None)
+	energy,grad,rms=surface.energy_gradient(geo)
+	out=open(base+'.out','w')
+	out.write("                       INPUT FILE\n")
+	for i in range(len(lines)):
+		out.write("|%3d> %s"%(i+1,lines[i]))
+	out.write("\n                       ****END OF INPUT****\n\n")
+	out.flush()
+	if (mode=='stall'):
+		while True:
+			time.sleep(60)
+	if (mode=='noenergy'):
+		out.close()
+		sys.exit(0)
+	if (mode=='scf'):
+		out.write("                   *****************************************************\n")
+		out.write("                   *                      ERROR                        *\n")
+		out.write("                   *           SCF NOT CONVERGED AFTER 125 CYCLES      *\n")
+		out.write("                   *****************************************************\n\n")
+	else:
+		out.write("               *****************************************************\n")
+		out.write("               *                     SUCCESS                       *\n")
+		out.write("               *           SCF CONVERGED AFTER  12 CYCLES          *\n")
+		out.write("               *****************************************************\n\n")
+	out.write("FINAL SINGLE POINT ENERGY     %20.12f\n\n"%(energy))
+	if ('engrad' in keywords):
+		out.write("------------------\nCARTESIAN GRADIENT\n------------------\n\n")
+		for i in range(len(geo)):
+			out.write("%4d   %-2s  :%15.9f%15.9f%15.9f\n"%(i+1,geo.symbols[i],grad[3*i],grad[(3*i)+1],grad[(3*i)+2]))
+		out.write("\nNorm of the cartesian gradient     ...    %.9f\n"%(np.linalg.norm(grad)))
+		out.write("RMS gradient                       ...    %.9f\n"%(rms))
+		out.write("MAX gradient                       ...    %.9f\n\n"%(np.max(np.abs(grad))))
+		open(base+'.gbw','w').close()
+	out.write("                             ****ORCA TERMINATED NORMALLY****\n")
+	out.close()
@@ -0,0 +1,269 @@
+#! /usr/bin/env python3
+# -*- coding: utf8 -*-
+
+##########################################################################
+#                                                                        #
+# Program: irc-bench.py                                                  #
+#                                                                        #
+# Usage: irc-bench.py [configs.json] [results.json]                      #
+#                                                                        #
+# Runs ircdrv() for each configuration in configs.json (default: the     #
+# configs.json next to this script) against one of the analytic surfaces #
+# of IRC4Orca, and compares the resulting path to a reference IRC        #
+# integrated with very small steps on the same surface. The example runs #
+# recorded in the examples directory are replayed as well. For each case #
+# it reports the number of energy and gradient calculations, the wall    #
+# time spent in Python and in the ESS, the number of points, and the     #
+# deviation from the reference path. Results are written as JSON to      #
+# results.json (default: bench-results.json).                            #
+#                                                                        #
+##########################################################################
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(here))
+import irc4orca
+
+#####################
+# Reference paths   #
+#####################
+
+def referencePath(backend,geo,mass,h=1.0e-3,maxsteps=20000):
+	#steepest descent paths from the TS in geo, in mass-weighted
+	# coordinates and with RK4 steps of length h -> list of the points of
+	# both branches (in angs), from one end of the path to the other
+	sqm=np.sqrt(np.repeat(mass,3))
+	x0=geo.flat().copy()
+	H=backend.hessian(geo)
+	w,modes=np.linalg.eigh(H/np.outer(sqm,sqm))
+	def slope(q):
+		g=backend.energy_gradient(irc4orca.geodisplace(geo,None,(q/sqm)-x0))[1]/sqm
+		return -g/np.linalg.norm(g)
+	branches=[]
+	for sign in (-1.0,1.0):
+		q=(x0*sqm)+(sign*10.0*h*modes[:,0])
+		pts=[q/sqm]
+		E=backend.energy(irc4orca.geodisplace(geo,None,(q/sqm)-x0))
+		for n in range(maxsteps):
+			k1=slope(q)
+			k2=slope(q+(0.5*h*k1))
+			k3=slope(q+(0.5*h*k2))
+			k4=slope(q+(h*k3))
+			qn=q+(h*(k1+(2.0*k2)+(2.0*k3)+k4)/6.0)
+			En=backend.energy(irc4orca.geodisplace(geo,None,(qn/sqm)-x0))
+			if (En>=E):
+				break #reached the minimum
+			q,E=qn,En
+			pts.append(q/sqm)
+		branches.append(pts)
+	return branches[0][::-1]+[x0]+branches[1]
+
+def pathDeviation(points,ref):
+	#distance (angs) from each point to the polyline ref
+	ref=np.array(ref)
+	a=ref[:-1]
+	ab=ref[1:]-a
+	ab2=np.maximum(np.sum(ab*ab,axis=1),1.0e-30)
+	dist=[]
+	for p in points:
+		t=np.clip(np.sum((p-a)*ab,axis=1)/ab2,0.0,1.0)
+		d=p-(a+(t[:,None]*ab))
+		dist.append(np.sqrt(np.min(np.sum(d*d,axis=1))))
+	return np.array(dist)
+
+######################
+# Trajectories, logs #
+######################
+
+def readTrj(fname):
+	#frames of a trj file -> list of (energy, coordinates as 3N array)
+	frames=[]
+	if not os.path.exists(fname):
+		return frames
+	trj=irc4orca.TrjReader(fname)
+	for i in range(len(trj)):
+		frames.append((trj.energy(i),trj.geometry(i).flat().copy()))
+	trj.close()
+	return frames
+
+def readLog(fname):
+	#points and termination of an IRC4Orca log -> (list of (n,E,RMS), reason)
+	points=[]
+	reason='unknown'
+	lfile=open(fname,'r')
+	for line in lfile:
+		if line.startswith('@'):
+			l=line.split()
+			points.append((int(l[1]),float(l[2]),float(l[3])))
+		elif 'MAXPTS ACHIEVED' in line:
+			reason='maxpts'
+		elif 'TOL ACHIEVED' in line:
+			reason='tolerance'
+		elif 'ENERGY INCREASED' in line:
+			reason='energy increased'
+	lfile.close()
+	return (points,reason)
+
+##############
+# Benchmarks #
+##############
+
+def writeHess(fname,surface,geo):
+	#hess file of the TS in geo on an analytic surface, for the runs of
+	# fake-orca.py (which need #irchess, as Orca)
+	backend=irc4orca.BACKENDS[surface](None)
+	mass=np.array([irc4orca.ATOMMASS.get(s,1.0) for s in geo.symbols])
+	H=backend.hessian(geo)
+	freqs,modes=irc4orca.vibrations(geo,mass,H)
+	irc4orca.writeHessFile(fname,geo,mass,backend.energy(geo),H,freqs,modes)
+
+def branchResults(params,ref):
+	#calls, points and deviation from ref of the branches of a run
+	result={}
+	result['energy_calls']=sum([b.nenergy for b in params.branches])
+	result['gradient_calls']=sum([b.ngrad for b in params.branches])
+	ends=[ref[0],ref[-1]]
+	result['branches']=[]
+	for b in params.branches:
+		points,reason=readLog(b.basename+'.log')
+		frames=readTrj(b.basename+'.trj')
+		br={'direction':b.direction, 'points':len(points), 'termination':reason}
+		if (len(frames)>0):
+			dev=pathDeviation([f[1] for f in frames],ref)
+			final=frames[-1][1]
+			br['final_energy']=frames[-1][0]
+			br['max_deviation']=float(np.max(dev))
+			br['mean_deviation']=float(np.mean(dev))
+			br['endpoint_error']=float(min([np.linalg.norm(final-e) for e in ends]))
+		if os.path.exists(b.basename+'.end.xyz'):
+			#endpoint optimized with #ircendopt
+			opt=irc4orca.readXYZ(b.basename+'.end.xyz').flat()
+			br['optimized_energy']=b.optE
+			br['optimized_endpoint_error']=float(min([np.linalg.norm(opt-e) for e in ends]))
+		if os.path.exists(b.basename+'.end.hess'):
+			#Hessian of the endpoint with #ircendhess
+			br['endpoint_frequencies']=[float(f) for f in irc4orca.readHessFile(b.basename+'.end.hess',False)['frequencies']]
+		result['branches'].append(br)
+	result['points']=sum([br['points'] for br in result['branches']])
+	return result
+
+def runConfig(conf,wdir):
+	#runs one configuration in wdir -> dictionary with the results
+	inpname=os.path.join(wdir,conf['name']+'.inp')
+	inpfile=open(inpname,'w')
+	if conf.get('orca',False):
+		#through fake-orca.py, i.e., the Orca backend with its cache,
+		# checkpoints and failures
+		hessname=os.path.join(wdir,conf['name']+'.ts.hess')
+		geo=irc4orca.Geometry([a[0] for a in conf['geometry']],[[float("%12.8f"%(x)) for x in a[1:]] for a in conf['geometry']])
+		writeHess(hessname,conf['surface'],geo)
+		inpfile.write("#orcacmd %s\n"%(os.path.join(here,'fake-orca.py')))
+		inpfile.write("#irchess %s\n"%(hessname))
+		os.environ['FAKE_ORCA_SURFACE']=conf['surface']
+		os.environ['FAKE_ORCA_COUNTER']=os.path.join(wdir,conf['name']+'.count')
+		os.environ['FAKE_ORCA_FAIL']=conf.get('fail','')
+	else:
+		inpfile.write("#ircbackend %s\n"%(conf['surface']))
+	for k,v in conf['options'].items():
+		inpfile.write("#%s %s\n"%(k,v))
+	if conf.get('orca',False):
+		inpfile.write("! HF def2-SVP\n")
+	inpfile.write("*xyz 0 1\n")
+	for a in conf['geometry']:
+		inpfile.write("%s %12.8f %12.8f %12.8f\n"%tuple(a))
+	inpfile.write("*\n")
+	inpfile.close()
+	t0=time.time()
+	params=irc4orca.ircdrv(inpname)
+	wall=time.time()-t0
+	os.environ.pop('FAKE_ORCA_FAIL',None) #only the first run fails
+	result={'name':conf['name'], 'surface':conf['surface'], 'options':conf['options']}
+	esstime=sum([b.esstime for b in params.branches])
+	result['wall_time']=wall
+	result['ess_time']=esstime
+	result['python_time']=max(0.0,wall-esstime)
+	if conf.get('orca',False):
+		ref=referencePath(irc4orca.BACKENDS[conf['surface']](None),geo,params.mass)
+	else:
+		ref=referencePath(params.backend,irc4orca.ToolKit(inpname).geometry,params.mass)
+	result.update(branchResults(params,ref))
+	# the same input run again, from the start ('rerun') or from the
+	# checkpoints ('resume')
+	result['repeats']=[]
+	for mode in conf.get('repeat',[]):
+		if (mode=='rerun'):
+			for b in params.branches:
+				os.remove(b.basename+'.log') #the logs are appended to
+		params=irc4orca.ircdrv(inpname,mode=='resume')
+		rep=branchResults(params,ref)
+		rep['mode']=mode
+		result['repeats'].append(rep)
+	return result
+
+def replayExample(logname):
+	#summary of a recorded example run (no calculations are done)
+	inpname=logname.replace('_example.log','.inp')
+	algorithm=1
+	if os.path.exists(inpname):
+		for line in open(inpname,'r'):
+			if 'ircalg' in line.lower():
+				algorithm=int(line.split()[-1])
+	points,reason=readLog(logname)
+	frames=readTrj(logname.replace('.log','.trj'))
+	# the Morokuma algorithms use 2 gradients and 2 (alg. 1) or 4 (alg. 2)
+	# single points per point
+	nsp={1:2, 2:4}.get(algorithm,0)
+	result={'name':os.path.basename(logname), 'surface':'recorded', 'options':{'ircalg':algorithm}}
+	result['points']=len(points)
+	result['energy_calls']=nsp*len(points)
+	result['gradient_calls']=2*len(points)
+	br={'points':len(points), 'termination':reason}
+	if (len(points)>0):
+		br['final_energy']=points[-1][1]
+		br['energy_drop']=points[0][1]-min([p[1] for p in points])
+	if (len(frames)>1):
+		xyz=np.array([f[1] for f in frames])
+		br['path_length']=float(np.sum(np.linalg.norm(np.diff(xyz,axis=0),axis=1)))
+	result['branches']=[br]
+	return result
+
+if (__name__=='__main__'):
+	confname=os.path.join(here,'configs.json')
+	outname='bench-results.json'
+	if (len(sys.argv)>1):
+		confname=sys.argv[1]
+	if (len(sys.argv)>2):
+		outname=sys.argv[2]
+	cfile=open(confname,'r')
+	configs=json.load(cfile)
+	cfile.close()
+	wdir=tempfile.mkdtemp(prefix='irc-bench.')
+	results=[]
+	try:
+		for conf in configs:
+			results.append(runConfig(conf,wdir))
+	finally:
+		shutil.rmtree(wdir,ignore_errors=True)
+	for logname in sorted(glob.glob(os.path.join(os.path.dirname(here),'examples','*_example.log'))):
+		results.append(replayExample(logname))
+	print("%-28s %6s %6s %6s %9s %9s %9s  %s"%('Case','Points','E.SP','Grad.','Wall (s)','ESS (s)','Max.Dev.','End.Err. (per branch)'))
+	for r in results:
+		dev=[br['max_deviation'] for br in r['branches'] if 'max_deviation' in br]
+		sdev='-'
+		if (len(dev)>0):
+			sdev="%9.2e"%(max(dev))
+		send=' '.join(["%8.2e"%(br['endpoint_error']) for br in r['branches'] if 'endpoint_error' in br])
+		print("%-28s %6d %6d %6d %9.3f %9.3f %9s  %s"%(r['name'][:28],r['points'],r['energy_calls'],r['gradient_calls'],r.get('wall_time',0.0),r.get('ess_time',0.0),sdev,send))
+		for rep in r.get('repeats',[]):
+			print("%-28s %6d %6d %6d"%(('  then '+rep['mode'])[:28],rep['points'],rep['energy_calls'],rep['gradient_calls']))
+	ofile=open(outname,'w')
+	json.dump({'irc4orca':'2.0', 'date':time.strftime('%Y-%m-%d %H:%M:%S'), 'results':results},ofile,indent=1)
+	ofile.close()
@@ -5,7 +5,9 @@
 #                                                                        #
 # Programa: irc4orca                        Date: 29/01/2018             #
 #                                                                        #
-# Usage: irc4orca.py inpfilename                                         #
+# Usage: irc4orca.py [--resume] inpfilename                              #
+#        irc4orca.py [--resume] --batch manifest.json                    #
+#        irc4orca.py --worker spooldir                                   #
 #                                                                        #
 # This is a wrapper that implements Morokuma's IRC algorithm in Cartesian#
 # coordinates (J. Phys. Chem. 66, 2153), with some modifications.        #
@@ -25,12 +27,21 @@
 # Mandatory instructions (unless it's a restart):                        #
 #                                                                        #
 # #irchess filename.hess      - location of the file hess file for the   #
-#                               system                                   #
-#                                                                        #
-# #ircmode n                  - Vibrational mode to follow (default:0)   #
+#                               system (its arrays are kept in           #
+#                               filename.hess.npz for the next runs)     #
 #                                                                        #
 # Optional instructions:                                                 #
 #                                                                        #
+# #ircmode n                  - Vibrational mode to follow (default:     #
+#                               auto, the imaginary mode of the TS). The #
+#                               run stops before any calculation if the  #
+#                               hess file has no imaginary frequency.    #
+#                                                                        #
+# #irchint file.xyz           - Reactant or product geometry, used to    #
+#                               choose the mode when there are several   #
+#                               imaginary modes (the one that overlaps   #
+#                               most with the way to this geometry).     #
+#                                                                        #
 # #ircrestart [0/1]           - This is a restart from a point in the    #
 #                               IRC that is not the TS (default:0/False) #
 #                                                                        #
@@ -54,8 +65,11 @@
 #                               considering the IRC to have converged    #
 #                               (default:1.0e-4).                        #
 #                                                                        #
-# #ircdir [-1/+1]             - Direction of the initial displacement    #
-#                               (default: +1).                           #
+# #ircdir [-1/+1/both]        - Direction of the initial displacement    #
+#                               (default: +1). With "both", the forward  #
+#                               and reverse branches run at the same     #
+#                               time, logging to basename-f/-r.log, and  #
+#                               basename-merged.trj is written at the end#
 #                                                                        #
 # #ircmaxd                    - Maximum norm of the displacement vector  #
 #                               (default: 0.01 angs/amu^(1/2)).          #
@@ -63,10 +77,181 @@
 # #ircpts                     - Maximum number of points in the IRC      #
 #                               (default: 25)                            #
 #                                                                        #
-# #ircalg [1/2]               - IRC algorithm: 1 (default) is the        #
+# #ircadapt [0/1]             - Adapt the displacement of algorithms 1-3 #
+#                               to the path: ircmaxd is only the first   #
+#                               step, which grows while the line search  #
+#                               predicts the energy well and the         #
+#                               gradient does not drop quickly, and      #
+#                               shrinks when the prediction is poor.     #
+#                               Points where the energy increases are    #
+#                               rejected and retried with half the step, #
+#                               unless the gradient is already below 10  #
+#                               times irctol (default: 0, False).        #
+#                                                                        #
+# #ircdmin x.xx               - Smallest step with ircadapt (default:    #
+#                               0.25*ircmaxd).                           #
+#                                                                        #
+# #ircdmax x.xx               - Largest step with ircadapt (default:     #
+#                               5*ircmaxd).                              #
+#                                                                        #
+# #ircalg [1/2/3/4]           - IRC algorithm: 1 (default) is the        #
 #                               traditional Morokuma algorithm.          #
 #                               2 is an updated version that requires    #
 #                               3 additional energy evaluations per step.#
+#                               3 fits the line search using the gradient#
+#                               at the displaced point, and requires one #
+#                               additional energy evaluation per step, or#
+#                               none while the fitted curvature keeps    #
+#                               predicting the energies well and puts    #
+#                               the minimum within ircdelta.             #
+#                               4 is a Hessian-based predictor-corrector #
+#                               integrator (Hratchian and Schlegel, with #
+#                               a LQA predictor) that starts from the    #
+#                               Hessian in the hess file, updates it     #
+#                               after every gradient and requires one    #
+#                               gradient per point.                      #
+#                                                                        #
+# #ircstep x.xx               - Length of each step of algorithm 4       #
+#                               (default: 0.1 bohr amu^(1/2)).           #
+#                                                                        #
+# #irchupdate [bofill/bfgs]   - Hessian update used by algorithm 4       #
+#                               (default: bofill).                       #
+#                                                                        #
+# #ircbackend name            - Provider of energies and gradients:      #
+#                               orca (default), or one of the analytic   #
+#                               surfaces mullerbrown (first atom only)   #
+#                               and morse (Morse cluster), which run in  #
+#                               the wrapper itself. With an analytic     #
+#                               surface and no #irchess, the Hessian is  #
+#                               computed numerically, and its modes are  #
+#                               numbered from the lowest eigenvalue.     #
+#                                                                        #
+# #ircworkers n               - Number of Orca processes that may run at #
+#                               the same time for independent energy     #
+#                               evaluations (default: 1). With n>1,      #
+#                               algorithm 1 evaluates both candidates    #
+#                               for the third point together with the    #
+#                               second one.                              #
+#                                                                        #
+# #irccache [0/1]             - Keep energies and gradients in           #
+#                               basename.i4o.cache, so that known        #
+#                               geometries are never recomputed, even    #
+#                               across runs (default: 0, False). Not     #
+#                               used in multi-level IRCs.                #
+#                                                                        #
+# #irccachesize n             - Maximum number of entries in the cache.  #
+#                               The least recently used are discarded    #
+#                               first (default: 250).                    #
+#                                                                        #
+# #irccachegbw [0/1]          - Also keep the gbw file of each gradient  #
+#                               in basename.i4o.cache.gbw/, to be used   #
+#                               as guess when the gradient is taken from #
+#                               the cache (default: 0, False). This may  #
+#                               take a lot of disk space.                #
+#                                                                        #
+# #ircevents [0/1]            - Record every energy and gradient         #
+#                               calculation (duration, time in each      #
+#                               phase, SCF cycles, cache and guess) in   #
+#                               basename.i4o.events, as JSON lines, and  #
+#                               print a summary at the end of the log    #
+#                               (default: 0, False).                     #
+#                                                                        #
+# #ircbintrj [0/1]            - Also write every point (coordinates,     #
+#                               energy, gradient, RMS gradient, step and #
+#                               damp) to basename.trj.npy, a NumPy array #
+#                               that grows as the IRC runs and can be    #
+#                               loaded with np.load(), also as a memory  #
+#                               map (default: 0, False).                 #
+#                                                                        #
+# #irctimeout s               - Wall time limit (in seconds) for each    #
+#                               Orca calculation (default: 0, none).     #
+#                                                                        #
+# #ircstall s                 - Kill an Orca calculation whose output    #
+#                               does not grow for s seconds (default: 0, #
+#                               never).                                  #
+#                                                                        #
+# #ircretries n               - Number of times a failed calculation     #
+#                               (error, timeout or SCF not converged) is #
+#                               run again: with a new guess instead of   #
+#                               the gbw of the IRC, then with SlowConv,  #
+#                               and then with VerySlowConv SOSCF         #
+#                               (default: 3). If a step still fails, it  #
+#                               is tried once more from the last point,  #
+#                               with half the step, before the branch    #
+#                               stops (it can then be resumed).          #
+#                                                                        #
+# #ircscratch /path           - Directory (preferably on a local disk or #
+#                               tmpfs) in which each Orca calculation    #
+#                               runs in its own subdirectory (default:   #
+#                               $TMPDIR, or /tmp). Only the last gbw is  #
+#                               copied back at the end of the run.       #
+#                                                                        #
+# #ircspool /path             - Shared directory through which the Orca  #
+#                               calculations are sent to workers (which  #
+#                               may run on other nodes), started with:   #
+#                                 irc4orca.py --worker /path             #
+#                               Each worker runs one calculation at a    #
+#                               time, in its $TMPDIR, until /path/stop   #
+#                               exists. #orcacmd must work on the nodes  #
+#                               of the workers, and ircworkers (or the   #
+#                               batch slots) sets how many calculations  #
+#                               are sent at the same time. A worker that #
+#                               stops touching its claim for two minutes #
+#                               has died: its calculation counts as      #
+#                               failed, and is sent again (#ircretries). #
+#                                                                        #
+# #irclowlevel ! method       - Method line of a cheaper level of theory #
+#                               (may be repeated). The path is followed  #
+#                               with the low-level gradients, corrected  #
+#                               by the difference to the high level (the #
+#                               method in the input) at the last point   #
+#                               where both were computed.                #
+#                                                                        #
+# #irchighpts n               - Number of points near the TS computed    #
+#                               only at the high level (default: 2).     #
+#                                                                        #
+# #irchighdist x.xx           - Distance (angs) from the last high-level #
+#                               point after which the correction is      #
+#                               computed again (default: 0.1).           #
+#                                                                        #
+# #ircendhess [0/1]           - At the end of each branch, compute the   #
+#                               Hessian of its last point by central     #
+#                               differences of 6N gradients, run at the  #
+#                               same time on the ircworkers (or batch    #
+#                               slots), report its lowest frequencies,   #
+#                               and write it to basename.end.hess, in    #
+#                               the format of Orca (default: 0, False).  #
+#                                                                        #
+# #ircendhessstep x.xx        - Displacement of each coordinate for      #
+#                               ircendhess (default: 0.005 bohr).        #
+#                                                                        #
+# #ircendopt [0/1]            - Minimize the last point of each branch   #
+#                               that ended near a minimum (TOL ACHIEVED  #
+#                               or ENERGY INCREASED), with a             #
+#                               quasi-Newton (RFO) optimizer that starts #
+#                               from the Hessian updated along the IRC   #
+#                               and the gbw of the last gradient, and    #
+#                               write it to basename.end.xyz (default:   #
+#                               0, False). With ircendhess, the Hessian  #
+#                               is computed at the optimized geometry.   #
+#                                                                        #
+# #ircendoptcycles n          - Maximum number of cycles of ircendopt    #
+#                               (default: 50).                           #
+#                                                                        #
+# #ircendopttol x.xx          - RMS gradient (Eh/bohr) for ircendopt to  #
+#                               converge; the maximum gradient must be   #
+#                               below 3*x.xx (default: 3.0e-5, as in     #
+#                               TightOpt).                               #
+#                                                                        #
+# #ircsurrogate x.xx          - Predict the energies of the line search  #
+#                               with a gradient-enhanced Gaussian        #
+#                               process fitted to the last points, when  #
+#                               its uncertainty is below x.xx Eh (e.g.,  #
+#                               1.0e-5), instead of running Orca         #
+#                               (default: 0, off).                       #
+#                                                                        #
+# #ircsurrpts n               - Points kept in the surrogate model       #
+#                               (default: 10).                           #
 #                                                                        #
 #   NOTES: ircalpha and ircmaxd may be used together to fine tune the    #
 #          development of the IRC procedure. Small values of ircmaxd     #
@@ -87,6 +272,22 @@
 #          bellow 1.0e-5.                                                #
 #                                                                        #
 #                                                                        #
+# CHECKPOINTS: after every accepted point, the state of the IRC is saved #
+#          in basename.i4o.chk.npz (basename-f/-r with #ircdir both).    #
+#          An interrupted run is continued exactly where it stopped,     #
+#          without any new calculation before the next step, with:       #
+#                                                                        #
+#          irc4orca.py --resume inpfilename                              #
+#                                                                        #
+# BATCH MODE: many IRCs (several inputs, modes and directions) can be    #
+#          run at once from a manifest (JSON, or TOML with Python 3.11+) #
+#          listing the input, hess file, modes and directions of each    #
+#          TS, and the number of Orca processes ("slots") shared by all  #
+#          branches. Free slots go to the branches farthest from         #
+#          convergence. A table with the endpoints and barrier heights   #
+#          is written to the summary file of the manifest.               #
+#                                                                        #
+#                                                                        #
 # (c) Filipe Teixeira 2012 (Current version:08/12/2013)                  #
 #                                                                        #
 ##########################################################################
@@ -95,26 +296,384 @@
 
 import os
 import sys
+import glob
+import time
+import mmap
+import shutil
+import signal
+import socket
+import tempfile
+import copy
+import json
+import heapq
+import hashlib
+import threading
+import subprocess
+import collections
+import concurrent.futures
 import numpy as np
 
+BOHR=0.52917721 # angs
+AU2CM=5140.4871 # cm-1, frequency of a curvature of 1 Eh/(bohr^2 amu)
+
+# masses (amu) for the analytic backends, which do not need a hess file
+ATOMMASS={'H':1.008, 'He':4.003, 'Li':6.941, 'B':10.811, 'C':12.011,
+	'N':14.007, 'O':15.999, 'F':18.998, 'Ne':20.180, 'Na':22.990,
+	'Si':28.086, 'P':30.974, 'S':32.065, 'Cl':35.453, 'Ar':39.948,
+	'Br':79.904, 'Kr':83.798, 'I':126.904, 'Xe':131.293}
+
 #####################################
 # Defining classes to store data in #
 #####################################
 
-class Atom():
-	def __init__(self, line):
-		l=line.split()
-		self.symbol=l[0]
-		self.coords=np.array(list(map(float,l[1:])))
-	def printxyz(self):
-		return "%s %9.6f %9.6f %9.6f\n"%(self.symbol, self.coords[0], self.coords[1], self.coords[2])
+class Geometry():
+	# elements (tuple) and Cartesian coordinates (natoms x 3 array, in angs)
+	# of a structure. Text is only made for ESS inputs and trajectories
+	def __init__(self, symbols, coords):
+		self.symbols=tuple([str(s) for s in symbols])
+		self.coords=np.array(coords,dtype=float).reshape((-1,3))
+	def __len__(self):
+		return len(self.symbols)
+	def flat(self):
+		#coordinates as a 3N array
+		return self.coords.reshape(-1)
+	def xyzlines(self,prec=6):
+		return ["%s %*.*f %*.*f %*.*f\n"%(s,prec+3,prec,x[0],prec+3,prec,x[1],prec+3,prec,x[2]) for s,x in zip(self.symbols,self.coords)]
+	def printxyz(self,prec=6):
+		return ''.join(self.xyzlines(prec))
+
+class EvalCache():
+	# persistent cache of energies, gradients and (if usegbw) gbw files,
+	# keyed on the rounded coordinates, the elements and the method lines of
+	# the input. The file has one JSON object per line: each new entry (or
+	# discarded one) is appended, and the file is only rewritten when it
+	# has twice as many lines as entries
+	def __init__(self,fname,template,maxsize=250,prec=6,usegbw=False):
+		self.fname=fname
+		self.gbwdir=fname+'.gbw'
+		self.maxsize=maxsize
+		self.prec=prec
+		self.usegbw=usegbw
+		self.nlines=0
+		self.hits=0
+		self.misses=0
+		self.lock=threading.Lock()
+		method=[]
+		for line in template:
+			l=line.strip()
+			if (l=='') or l.startswith('%pal') or l.startswith('%maxcore'):
+				continue #these do not change the results
+			method.append(l)
+		self.method=hashlib.sha1('\n'.join(method).encode()).hexdigest()
+		self.entries=collections.OrderedDict()
+		if os.path.exists(fname):
+			cfile=open(fname,'r')
+			for line in cfile:
+				try:
+					entry=json.loads(line)
+				except ValueError:
+					continue #the last line of a run that was killed
+				self.nlines += 1
+				if ('key' not in entry):
+					self.entries.update(entry) #a whole cache, as written by version 2.0
+				elif entry.get('drop',False):
+					self.entries.pop(entry['key'],None)
+				else:
+					self.entries[entry.pop('key')]=entry
+			cfile.close()
+	def key(self,geo):
+		text=[self.method]
+		for symbol,xyz in zip(geo.symbols,geo.coords.tolist()):
+			text.append(symbol)
+			for x in xyz:
+				text.append("%.*f"%(self.prec,round(x,self.prec)+0.0))
+		return hashlib.sha1(' '.join(text).encode()).hexdigest()
+	def get(self,geo,needgrad=False):
+		#returns (a copy of) the entry for geo, with the gradient as an array,
+		# or None if it is not (fully) known
+		k=self.key(geo)
+		with self.lock:
+			entry=self.entries.get(k)
+			if (entry==None) or (needgrad and entry['grad']==None):
+				self.misses += 1
+				return None
+			self.entries.move_to_end(k)
+			self.hits += 1
+			entry=dict(entry)
+			if (entry['grad']!=None):
+				entry['grad']=np.array(entry['grad'])
+			return entry
+	def put(self,geo,energy,grad=None,rms=None,gbw=None):
+		k=self.key(geo)
+		with self.lock:
+			entry={'energy':energy, 'grad':None, 'rms':rms, 'gbw':None}
+			if (grad is not None):
+				entry['grad']=list(map(float,grad))
+			if self.usegbw and (gbw!=None) and os.path.exists(gbw):
+				os.makedirs(self.gbwdir,exist_ok=True)
+				entry['gbw']=os.path.join(self.gbwdir,k+'.gbw')
+				shutil.copyfile(gbw,entry['gbw'])
+			old=self.entries.get(k)
+			if (old!=None) and (entry['grad']==None):
+				self.entries.move_to_end(k)
+				return #do not replace a gradient by a single point
+			self.entries[k]=entry
+			self.entries.move_to_end(k)
+			lines=[dict(entry,key=k)]
+			while (len(self.entries)>self.maxsize):
+				k,old=self.entries.popitem(last=False)
+				if (old['gbw']!=None) and os.path.exists(old['gbw']):
+					os.remove(old['gbw'])
+				lines.append({'key':k, 'drop':True})
+			if ((self.nlines+len(lines))>(2*max(self.maxsize,len(self.entries)))):
+				self.save()
+			else:
+				cfile=open(self.fname,'a')
+				for line in lines:
+					cfile.write(json.dumps(line)+'\n')
+				cfile.close()
+				self.nlines += len(lines)
+	def save(self):
+		#rewrites the file with only the entries that are kept
+		cfile=open(self.fname+'.tmp','w')
+		for k,entry in self.entries.items():
+			cfile.write(json.dumps(dict(entry,key=k))+'\n')
+		cfile.close()
+		os.replace(self.fname+'.tmp',self.fname)
+		self.nlines=len(self.entries)
+	def summary(self):
+		total=self.hits+self.misses
+		rate=0.0
+		if (total>0):
+			rate=100.0*self.hits/total
+		return "  Cache %s: %d hits, %d misses (%.1f%% hit rate), %d entries\n"%(self.fname,self.hits,self.misses,rate,len(self.entries))
+
+class ScratchDir():
+	# directory for the temporary files of the calculations of this run,
+	# removed at the end of the run, or by the next run after a crash
+	def __init__(self,path):
+		path=os.path.expandvars(os.path.expanduser(path))
+		os.makedirs(path,exist_ok=True)
+		self.purge(path)
+		self.root=tempfile.mkdtemp(prefix='i4o.%s.%d.'%(socket.gethostname(),os.getpid()),dir=path)
+	def purge(self,path):
+		#removes the directories left behind by runs on this host that no
+		# longer exist (i4o.host.pid.xxxxxxxx)
+		for d in glob.glob(os.path.join(path,'i4o.*.*.*')):
+			l=os.path.basename(d).split('.')
+			if ('.'.join(l[1:-2])!=socket.gethostname()):
+				continue
+			try:
+				os.kill(int(l[-2]),0)
+			except ValueError:
+				continue
+			except ProcessLookupError:
+				shutil.rmtree(d,ignore_errors=True)
+			except PermissionError:
+				continue #alive, but not ours
+	def jobdir(self,name):
+		#new directory for one calculation
+		return tempfile.mkdtemp(prefix=name+'.',dir=self.root)
+	def cleanup(self):
+		shutil.rmtree(self.root,ignore_errors=True)
+
+class SlotPool():
+	# a fixed number of ESS slots shared by several IRC branches. A slot
+	# that frees up goes to the waiting branch with the highest priority
+	def __init__(self,n):
+		self.free=n
+		self.cond=threading.Condition()
+		self.waiting=[]
+		self.count=0
+	def acquire(self,priority):
+		with self.cond:
+			self.count += 1
+			entry=(-priority,self.count)
+			heapq.heappush(self.waiting,entry)
+			while (self.free<1) or (self.waiting[0]!=entry):
+				self.cond.wait()
+			heapq.heappop(self.waiting)
+			self.free -= 1
+			self.cond.notify_all()
+	def release(self):
+		with self.cond:
+			self.free += 1
+			self.cond.notify_all()
+
+class Spool():
+	# shared directory through which the calculations are run by workers
+	# (irc4orca.py --worker), possibly on other nodes. Each job is a
+	# self-contained directory, written in tmp/ and moved to new/ when it
+	# is complete, to run/ by the worker that claims it, and to done/, with
+	# its results and status.json, when it ends. The moves are renames, so
+	# that each job is seen whole, and claimed by only one worker
+	def __init__(self,path,poll=0.5,beat=10.0,grace=120.0):
+		self.root=os.path.abspath(os.path.expandvars(os.path.expanduser(path)))
+		self.poll=poll
+		self.beat=beat #the worker touches run/<job>/worker every beat s
+		self.grace=grace #a job not touched for this long has been lost
+		self.count=0
+		self.lock=threading.Lock()
+		for state in ('tmp','new','run','done'):
+			os.makedirs(os.path.join(self.root,state),exist_ok=True)
+	def path(self,state,jobid):
+		return os.path.join(self.root,state,jobid)
+	def submit(self,wdir,cmd,lname,timeout=0.0,stall=0.0):
+		#new job with the files in wdir, to run cmd lname.inp -> its id
+		# (the jobs are claimed in the order they were submitted)
+		with self.lock:
+			self.count += 1
+			jobid='%.6f.%s.%d.%d'%(time.time(),socket.gethostname(),os.getpid(),self.count)
+		tmp=self.path('tmp',jobid)
+		shutil.copytree(wdir,tmp)
+		jfile=open(os.path.join(tmp,'job.json'),'w')
+		json.dump({'cmd':cmd, 'name':lname, 'timeout':timeout, 'stall':stall},jfile)
+		jfile.close()
+		os.rename(tmp,self.path('new',jobid))
+		return jobid
+	def wait(self,jobid,wdir):
+		#waits for a job to end, and copies its results to wdir -> status.
+		# A job whose worker has stopped its heartbeat (it died, or its node
+		# went down) is given up. The job is removed from the spool in any
+		# case
+		done=self.path('done',jobid)
+		claimed=os.path.join(self.path('run',jobid),'worker')
+		try:
+			while not os.path.isdir(done):
+				try:
+					if ((time.time()-os.path.getmtime(claimed))>self.grace):
+						wfile=open(claimed,'r')
+						worker=wfile.read().strip()
+						wfile.close()
+						raise ESSTimeout("job %s was lost by its worker (%s)"%(jobid,worker))
+				except FileNotFoundError:
+					pass #not claimed yet, or it has just ended
+				time.sleep(self.poll)
+			sfile=open(os.path.join(done,'status.json'),'r')
+			status=json.load(sfile)
+			sfile.close()
+			for f in status['files']:
+				shutil.copyfile(os.path.join(done,f),os.path.join(wdir,f))
+			return status
+		finally:
+			for state in ('new','run','done'):
+				shutil.rmtree(self.path(state,jobid),ignore_errors=True)
+	def claim(self,worker):
+		#moves the oldest job in new/ to run/ -> its id (None if there is
+		# none left)
+		for jobid in sorted(os.listdir(os.path.join(self.root,'new'))):
+			try:
+				os.rename(self.path('new',jobid),self.path('run',jobid))
+			except OSError:
+				continue #claimed by another worker
+			wfile=open(os.path.join(self.path('run',jobid),'worker'),'w')
+			wfile.write("%s\n"%(worker))
+			wfile.close()
+			return jobid
+		return None
+	def run(self,jobid,scratch,worker):
+		#runs a claimed job in a new directory of scratch, and moves it to
+		# done/ with the output, gbw and stderr of the calculation
+		rdir=self.path('run',jobid)
+		jfile=open(os.path.join(rdir,'job.json'),'r')
+		job=json.load(jfile)
+		jfile.close()
+		wdir=scratch.jobdir(job['name'])
+		t0=time.time()
+		ended=threading.Event()
+		beat=threading.Thread(target=self.heartbeat,args=(jobid,ended),daemon=True)
+		beat.start()
+		try:
+			for f in os.listdir(rdir):
+				if (f not in ('job.json','worker')):
+					shutil.copyfile(os.path.join(rdir,f),os.path.join(wdir,f))
+			try:
+				returncode,err,killed=runJob(job['cmd'],job['name'],wdir,job['timeout'],job['stall'])
+			except OSError as e:
+				returncode,err,killed=(127,str(e),None) #no cmd on this node
+			status={'returncode':returncode, 'error':err, 'killed':killed,
+				'worker':worker, 'time':time.time()-t0, 'files':[]}
+			for ext in ('.out','.gbw','.err'):
+				f=job['name']+ext
+				if os.path.exists(os.path.join(wdir,f)):
+					shutil.copyfile(os.path.join(wdir,f),os.path.join(rdir,f))
+					status['files'].append(f)
+			sfile=open(os.path.join(rdir,'status.json'),'w')
+			json.dump(status,sfile)
+			sfile.close()
+			os.rename(rdir,self.path('done',jobid))
+		except OSError:
+			pass #the job was given up, and removed from the spool
+		finally:
+			ended.set()
+			beat.join()
+			shutil.rmtree(wdir,ignore_errors=True)
+	def heartbeat(self,jobid,ended):
+		#touches run/<job>/worker every beat s until ended is set, so that
+		# the driver knows the worker is still running the job
+		claimed=os.path.join(self.path('run',jobid),'worker')
+		while not ended.wait(self.beat):
+			try:
+				os.utime(claimed)
+			except OSError:
+				return #given up, or already in done/
+
+def geohash(geo):
+	#short hash of a geometry, rounded as in the trajectory files
+	text=' '.join(geo.xyzlines())
+	return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+class EventLog():
+	# stream of the energy and gradient calculations (basename.i4o.events),
+	# one JSON object per line, and totals for the summary in the log
+	def __init__(self,fname):
+		self.fname=fname
+		self.lock=threading.Lock()
+		self.out=open(fname,'a',1)
+		self.stats=collections.OrderedDict()
+	def record(self,pars,kind,geo,t0,duration,cache,info):
+		event={'time':t0, 'branch':pars.basename, 'kind':kind,
+			'duration':duration, 'geometry':geohash(geo), 'cache':cache}
+		event.update(info)
+		with self.lock:
+			self.out.write(json.dumps(event)+'\n')
+			st=self.stats.setdefault(kind,{'calls':0, 'cached':0, 'time':0.0,
+				'scf':0, 'nscf':0, 'phases':collections.OrderedDict()})
+			st['calls'] += 1
+			st['time'] += duration
+			if (cache=='hit'):
+				st['cached'] += 1
+			if (info.get('scf_cycles')!=None):
+				st['scf'] += info['scf_cycles']
+				st['nscf'] += 1
+			for k,v in info.get('phases',{}).items():
+				st['phases'][k]=st['phases'].get(k,0.0)+v
+	def summary(self):
+		o="\n  Calculations (see %s):\n"%(self.fname)
+		o+="  %-10s %6s %6s %10s %9s %6s   %s\n"%('Type','Calls','Cached','Total (s)','Mean (s)','SCF','Time per phase (s)')
+		for kind,st in self.stats.items():
+			ncomp=st['calls']-st['cached']
+			mean=0.0
+			if (ncomp>0):
+				mean=st['time']/ncomp
+			scf='-'
+			if (st['nscf']>0):
+				scf="%6.1f"%(st['scf']/float(st['nscf']))
+			phases=' '.join(["%s %.2f"%(k,v) for k,v in st['phases'].items()])
+			o+="  %-10s %6d %6d %10.2f %9.3f %6s   %s\n"%(kind,st['calls'],st['cached'],st['time'],mean,scf,phases)
+		return o
+	def close(self):
+		self.out.close()
 
 class ToolKit():
 	# just a placeholder for all common data
-	def __init__(self,name):
+	def __init__(self,name,extra=[],basename=None):
+		#extra instructions are read after those in the input file
 		natoms=1
 		self.alpha=0.1
 		self.basename='.'.join(name.split('.')[:-1])
+		if (basename!=None):
+			self.basename=basename
 		self.out=open("%s.log"%(self.basename),'a',1)
 		self.delta=0.05
 		self.direction=1
@@ -122,23 +681,105 @@ class ToolKit():
 		self.energy=0.00
 		self.geos=[]
 		self.restart=False
-		self.geometry=[]
+		self.geometry=None
 		self.guessfn=''
 		self.damp=0.05
 		self.algorithm=1
+		self.workers=1
+		self.timeout=0.0 #limits for each Orca calculation (s)
+		self.stall=0.0
+		self.retries=3
+		self.nfailed=0 #failed calculations, and those that worked again
+		self.nrecovered=0
+		self.nenergy=0 #energy and gradient calculations, and the time spent
+		self.ngrad=0   # in them (s)
+		self.esstime=0.0
+		self.lock=threading.Lock()
+		self.lscurv=0.0
+		self.lspred=0.0
+		self.lstrusted=False
+		self.step=0.1
+		self.hupdate='bofill'
+		self.hpcref=None
+		self.usecache=False
+		self.cachegbw=False #keep the gbw files in the cache too?
+		self.cachesize=250
+		self.cache=None
+		self.useevents=False
+		self.events=None
+		self.scratchdir=tempfile.gettempdir() # $TMPDIR
+		self.scratch=None
+		self.spooldir='' #calculations run by workers through a spool
+		self.spool=None
+		self.trj=None #TrjWriter, opened at the first point
+		self.usebintrj=False
+		self.bintrj=None #BinTrjWriter
+		self.point=0 #last accepted point, for checkpoints
+		self.oldE=0.0
+		self.finished=False
+		self.termination=''
+		self.endE=0.0
+		self.slots=None #ESS slots shared by several branches (batch mode)
+		self.priority=float('inf')
 		self.autodamp=False
 		self.prevgrad=0.0
 		self.hessfn=''
 		self.maxdispl=0.01
-		self.mode=0
+		self.adapt=False #adaptive step (algorithms 1-3)
+		self.dmin=0.0
+		self.dmax=0.0
+		self.nrejected=0
+		self.laststep=0.0 #length of the step to the last point
+		self.mode=None #auto
+		self.modeinfo=[]
+		self.hintfn=''
 		self.dgrad=0.0
 		self.natoms=natoms
+		self.frequencies=None
 		self.npoints=25
 		self.template=[]
+		self.lowtemplate=[] #multi-level IRC
+		self.highpts=2
+		self.highdist=0.1
+		self.endhess=False #numerical Hessian at the end of each branch
+		self.endhessstep=0.005
+		self.endopt=False #minimization of the end of each branch
+		self.endoptcycles=50
+		self.endopttol=3.0e-5
+		self.optgeo=None #optimized endpoint, and its energy
+		self.optE=0.0
+		self.gradhist=collections.deque(maxlen=50) #last computed gradients
+		self.surrtol=0.0 #surrogate model of the line search (0: off)
+		self.surrpts=10
+		self.surrogate=None
 		self.tolerance=1.0e-04
 		self.orcacmd='UNDEFINED'
-		self.ReadInput(name)
-		self.ReadHessian()
+		self.backendname='orca'
+		self.ReadInput(name,extra)
+		self.backend=BACKENDS[self.backendname](self)
+		if (self.backend.analytic and (self.hessfn=='')):
+			self.AnalyticHessian()
+		else:
+			self.ReadHessian()
+		if (self.surrtol>0.0):
+			if (self.backendname=='multilevel'):
+				#the corrected surface changes with each new correction
+				self.out.write("  The surrogate model is not used in multi-level IRCs\n")
+				self.surrtol=0.0
+			else:
+				self.surrogate=Surrogate(self)
+		if (self.usecache and (self.backendname=='multilevel')):
+			#the corrected results depend on the corrections made so far
+			self.out.write("  The cache is not used in multi-level IRCs\n")
+			self.usecache=False
+		if (self.usecache and not self.backend.analytic):
+			self.cache=EvalCache(self.basename+'.i4o.cache',self.template+self.lowtemplate,self.cachesize,usegbw=self.cachegbw)
+		if (self.useevents):
+			self.events=EventLog(self.basename+'.i4o.events')
+		if (not self.backend.analytic):
+			self.scratch=ScratchDir(self.scratchdir)
+			if (self.spooldir!=''):
+				self.spool=Spool(self.spooldir)
 	def printPars(self):
 		stmp="  %13s: %s\n"
 		ftmp="  %13s: %7.4f\n"
@@ -146,11 +787,30 @@ class ToolKit():
 		self.out.write('')
 		self.out.write(itmp%('Algorithm',self.algorithm))
 		self.out.write(itmp%('N. Points',self.npoints))
+		self.out.write(itmp%('Workers',self.workers))
+		self.out.write(itmp%('Retries',self.retries))
+		if (self.timeout>0.0):
+			self.out.write(ftmp%('Time Limit',self.timeout))
+		if (self.stall>0.0):
+			self.out.write(ftmp%('Stall Limit',self.stall))
+		self.out.write(itmp%('Cache',self.cache!=None))
+		if (self.cache!=None) and self.cachegbw:
+			self.out.write(stmp%('Cache gbw',self.cache.gbwdir))
 		self.out.write(ftmp%('Grad. Tol.',self.tolerance))
 		self.out.write('')
+		self.out.write(stmp%('Backend',self.backendname))
 		self.out.write(stmp%('Hessian',self.hessfn))
 		self.out.write(itmp%('Mode',self.mode))
-		self.out.write(itmp%('Direction',self.direction))
+		for line in self.modeinfo:
+			self.out.write("  %13s  %s\n"%('',line))
+		if (self.direction==0):
+			self.out.write(stmp%('Direction','both'))
+		else:
+			self.out.write(itmp%('Direction',self.direction))
+		if (len(self.lowtemplate)>0):
+			self.out.write(stmp%('Low Level',self.lowtemplate[0].strip()))
+			self.out.write(itmp%('High Pts.',self.highpts))
+			self.out.write(ftmp%('High Dist.',self.highdist))
 		self.out.write('')
 		self.out.write(ftmp%('Alpha',self.alpha))
 		self.out.write(ftmp%('Delta',self.delta))
@@ -159,22 +819,88 @@ class ToolKit():
 		self.out.write(itmp%('Damp Update',self.autodamp))
 		self.out.write('')
 		self.out.write(ftmp%('Max. Displ.',self.maxdispl))
+		if (self.adapt):
+			self.out.write(ftmp%('Min. Step',self.dmin))
+			self.out.write(ftmp%('Max. Step',self.dmax))
+		if (self.algorithm==4):
+			self.out.write(ftmp%('Step',self.step))
+			self.out.write(stmp%('Hess. Update',self.hupdate))
+		if (self.endhess):
+			self.out.write(ftmp%('End Hess Step',self.endhessstep))
+		if (self.endopt):
+			self.out.write(stmp%('End Opt.','%d cycles, RMS grad. %.1e'%(self.endoptcycles,self.endopttol)))
+		if (self.surrogate!=None):
+			self.out.write(stmp%('Surrogate','%.1e Eh, %d points'%(self.surrtol,self.surrpts)))
 		self.out.write('')
 		self.out.write(stmp%('Guess',self.guessfn))
+		if (self.scratch!=None):
+			self.out.write(stmp%('Scratch',self.scratch.root))
+		if (self.spool!=None):
+			self.out.write(stmp%('Spool',self.spool.root))
 		self.out.write("\n------------------------------------------------\n")
-	def ReadInput(self,name):
+	def ReadInput(self,name,extra=[]):
 		#parse inp file
 		ifile=open(name,'r')
-		idata=ifile.readlines()
+		idata=ifile.readlines()+[l+'\n' for l in extra]
 		ifile.close()
 		ingeo=False
+		def methodline(line):
+			#line of the input as used in the template of each calculation
+			line=line.lower()
+			line=line.replace('sp',' ')
+			line=line.replace('engrad',' ')
+			line=line.replace('opt',' ')
+			line=line.replace('numfreq',' ')
+			line=line.replace('moread',' ')
+			if ('moinp' in line): 
+				line='\n'
+			return line
+		lowlevel=[]
+		symbols=[]
+		coords=[]
 		for line in idata:
-			copy=True
+			copyline=True
 			if ingeo:
-				copy=False
+				copyline=False
 			if '#' in line:
-				copy=False
-				if 'irches' in line.lower(): #hess file name
+				copyline=False
+				if 'irclowlevel' in line.lower(): #method line of the low level
+					k=line.lower().index('irclowlevel')+len('irclowlevel')
+					lowlevel.append(methodline(line[k:].strip()+'\n'))
+				elif 'irchighpts' in line.lower(): #points done at the high level only
+					l=line.split()
+					self.highpts=int(l[-1])
+				elif 'irchighdist' in line.lower(): #distance between high-level points
+					l=line.split()
+					self.highdist=float(l[-1])
+				elif 'ircsurrogate' in line.lower(): #uncertainty of the surrogate energies
+					l=line.split()
+					self.surrtol=float(l[-1])
+				elif 'ircsurrpts' in line.lower(): #points in the surrogate model
+					l=line.split()
+					self.surrpts=int(l[-1])
+				elif 'ircendhessstep' in line.lower(): #displacement for ircendhess
+					l=line.split()
+					self.endhessstep=float(l[-1])
+				elif 'ircendhess' in line.lower(): #Hessian of the endpoints?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.endhess=True
+					else:
+						self.endhess=False
+				elif 'ircendoptcycles' in line.lower(): #cycles of ircendopt
+					l=line.split()
+					self.endoptcycles=int(l[-1])
+				elif 'ircendopttol' in line.lower(): #RMS gradient for ircendopt
+					l=line.split()
+					self.endopttol=float(l[-1])
+				elif 'ircendopt' in line.lower(): #minimize the endpoints?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.endopt=True
+					else:
+						self.endopt=False
+				elif 'irches' in line.lower(): #hess file name
 					l=line.split()
 					self.hessfn=l[-1]
 				elif 'orcacmd' in line.lower(): # orca executable
@@ -210,12 +936,87 @@ class ToolKit():
 				elif 'ircalg' in line.lower(): # algorithm
 					l=line.split()
 					self.algorithm=int(l[-1])
-				elif 'ircdir' in line.lower(): # direction +1 or -1
+				elif 'irccachesize' in line.lower(): # entries kept in the cache
+					l=line.split()
+					self.cachesize=int(l[-1])
+				elif 'irccachegbw' in line.lower(): # gbw files in the cache?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.cachegbw=True
+					else:
+						self.cachegbw=False
+				elif 'irccache' in line.lower(): # use the evaluation cache?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.usecache=True
+					else:
+						self.usecache=False
+				elif 'ircstep' in line.lower(): # step length for algorithm 4
+					l=line.split()
+					self.step=float(l[-1])
+				elif 'irchupdate' in line.lower(): # hessian update for algorithm 4
+					l=line.split()
+					self.hupdate=l[-1].lower()
+				elif 'ircbackend' in line.lower(): # provider of energies and gradients
+					l=line.split()
+					self.backendname=l[-1].lower()
+				elif 'ircevents' in line.lower(): # record every calculation?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.useevents=True
+					else:
+						self.useevents=False
+				elif 'ircbintrj' in line.lower(): # binary trajectory?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.usebintrj=True
+					else:
+						self.usebintrj=False
+				elif 'irctimeout' in line.lower(): # wall time of each calculation
+					l=line.split()
+					self.timeout=float(l[-1])
+				elif 'ircstall' in line.lower(): # time without output
 					l=line.split()
-					self.direction=int(l[-1])
+					self.stall=float(l[-1])
+				elif 'ircretries' in line.lower(): # attempts after a failure
+					l=line.split()
+					self.retries=max(0,int(l[-1]))
+				elif 'ircscratch' in line.lower(): # directory for temporary files
+					l=line.split()
+					self.scratchdir=l[-1]
+				elif 'ircspool' in line.lower(): # shared directory for workers
+					l=line.split()
+					self.spooldir=l[-1]
+				elif 'ircworkers' in line.lower(): # concurrent Orca processes
+					l=line.split()
+					self.workers=max(1,int(l[-1]))
+				elif 'ircdir' in line.lower(): # direction +1, -1 or both (0)
+					l=line.split()
+					if (l[-1].lower()=='both'):
+						self.direction=0
+					else:
+						self.direction=int(l[-1])
 				elif 'ircmode' in line.lower(): # mode number (same numbering as in hess)
 					l=line.split()
-					self.mode=int(l[-1])
+					if (l[-1].lower()=='auto'):
+						self.mode=None
+					else:
+						self.mode=int(l[-1])
+				elif 'irchint' in line.lower(): # reactant or product geometry
+					l=line.split()
+					self.hintfn=l[-1]
+				elif 'ircadapt' in line.lower(): # adaptive step?
+					l=line.split()
+					if (int(l[-1])==1):
+						self.adapt=True
+					else:
+						self.adapt=False
+				elif 'ircdmin' in line.lower(): # bounds of the adaptive step
+					l=line.split()
+					self.dmin=float(l[-1])
+				elif 'ircdmax' in line.lower():
+					l=line.split()
+					self.dmax=float(l[-1])
 				elif 'ircmaxd' in line.lower(): # number of points to do
 					l=line.split()
 					self.maxdispl=float(l[-1])
@@ -225,175 +1026,1293 @@ class ToolKit():
 			if ('*' in line):
 				if (ingeo):
 					ingeo=False
-					copy=False
+					copyline=False
 				else:
 					ingeo=True
 			if (('*' not in line) and ingeo):
-				self.geometry.append(Atom(line))
-			if (copy):
-				line=line.lower()
-				line=line.replace('sp',' ')
-				line=line.replace('engrad',' ')
-				line=line.replace('opt',' ')
-				line=line.replace('numfreq',' ')
-				line=line.replace('moread',' ')
-				if ('moinp' in line): 
-					line='\n'
-				self.template.append(line)
+				l=line.split()
+				symbols.append(l[0])
+				coords.append(list(map(float,l[1:4])))
+			if (copyline):
+				self.template.append(methodline(line))
+		self.geometry=Geometry(symbols,coords)
 		self.natoms=len(self.geometry)
+		if (self.dmin<=0.0):
+			self.dmin=0.25*self.maxdispl
+		if (self.dmax<=0.0):
+			self.dmax=5.0*self.maxdispl
+		if (len(lowlevel)>0):
+			#the low level replaces the method lines (!) of the input, and
+			# shares its blocks, charge and multiplicity
+			self.lowtemplate=[l for l in lowlevel if l.strip()!='']
+			self.lowtemplate += [l for l in self.template if not l.lstrip().startswith('!')]
+			if (self.backendname=='orca'):
+				self.backendname='multilevel'
+	def branch(self,direction,suffix):
+		#copy of the toolkit for one direction of the IRC, with its own
+		# log, trajectory and gbw files
+		new=copy.copy(self)
+		new.direction=direction
+		new.basename=self.basename+suffix
+		new.out=open("%s.log"%(new.basename),'a',1)
+		new.trj=None
+		new.bintrj=None
+		new.energies=list(self.energies)
+		new.geos=list(self.geos)
+		new.geometry=self.geometry
+		new.template=list(self.template)
+		new.displacement=self.displacement.copy()
+		new.grad=self.grad.copy()
+		new.gradhist=collections.deque(self.gradhist,maxlen=self.gradhist.maxlen)
+		new.backend=BACKENDS[new.backendname](new)
+		if (self.surrogate!=None):
+			new.surrogate=Surrogate(new)
+		return new
+	def lastGuess(self,level=None):
+		#where the gbw of the last gradient calculation is kept during the run
+		if (level!=None):
+			return os.path.join(self.scratch.root,os.path.basename(self.basename)+'.i4o.%s.gbw'%(level))
+		return os.path.join(self.scratch.root,os.path.basename(self.basename)+'.i4o.last.gbw')
+	def saveGuess(self):
+		#copies the gbw of the last gradient calculation to the current dir.
+		if (self.scratch!=None) and (self.guessfn==self.lastGuess()) and os.path.exists(self.guessfn):
+			shutil.copyfile(self.guessfn,self.basename+'.i4o.last.gbw')
+	def CloseTrj(self):
+		for trj in (self.trj,self.bintrj):
+			if (trj!=None):
+				trj.close()
+	def State(self):
+		#state of the IRC after the last accepted point, as a dictionary of
+		# arrays (see WriteCheckpoint and SetState)
+		chk={'point':self.point, 'oldE':self.oldE, 'finished':self.finished,
+			'symbols':np.array(self.geometry.symbols),
+			'coords':self.geometry.coords.copy(),
+			'energy':self.energy, 'energies':np.array(self.energies),
+			'geos':np.array([g.coords for g in self.geos]).reshape((-1,self.natoms,3)),
+			'displacement':self.displacement.copy(), 'grad':self.grad.copy(),
+			'damp':self.damp, 'autodamp':self.autodamp, 'guessfn':self.guessfn,
+			'termination':self.termination, 'endE':self.endE,
+			'maxdispl':self.maxdispl, 'nrejected':self.nrejected,
+			'lscurv':self.lscurv, 'lspred':self.lspred, 'lstrusted':self.lstrusted}
+		if (self.hpcref!=None):
+			chk['hpc_q'],chk['hpc_E'],chk['hpc_g'],chk['hpc_H']=self.hpcref
+		if (self.backendname=='multilevel') and (self.backend.ref!=None):
+			chk['ml_x'],chk['ml_dE'],chk['ml_dg']=self.backend.ref
+		if (len(self.gradhist)>0):
+			chk['hist_x'],chk['hist_E'],chk['hist_g']=[np.array(v) for v in zip(*self.gradhist)]
+		return chk
+	def WriteCheckpoint(self):
+		#saves the state of the IRC after an accepted point
+		self.saveGuess()
+		chk=self.State()
+		if (self.scratch!=None) and (self.guessfn==self.lastGuess()):
+			chk['guessfn']=self.basename+'.i4o.last.gbw'
+		fname=self.basename+'.i4o.chk.npz'
+		cfile=open(fname+'.tmp','wb')
+		np.savez(cfile,**chk)
+		cfile.close()
+		os.replace(fname+'.tmp',fname)
+	def ReadCheckpoint(self):
+		#restores the state saved by WriteCheckpoint -> True if there was one
+		fname=self.basename+'.i4o.chk.npz'
+		if not os.path.exists(fname):
+			return False
+		chk=np.load(fname)
+		self.SetState(chk)
+		chk.close()
+		self.out.write("  Resuming from %s after point %d\n"%(fname,self.point))
+		return True
+	def SetState(self,chk):
+		#restores a state from State (or from a checkpoint)
+		def atoms(coords):
+			return Geometry(chk['symbols'],coords)
+		self.point=int(chk['point'])
+		self.oldE=float(chk['oldE'])
+		self.finished=bool(chk['finished'])
+		self.geometry=atoms(chk['coords'])
+		self.energy=float(chk['energy'])
+		self.energies=list(chk['energies'])
+		self.geos=[atoms(g) for g in chk['geos']]
+		self.displacement=chk['displacement'].copy()
+		self.grad=chk['grad'].copy()
+		self.damp=float(chk['damp'])
+		self.autodamp=bool(chk['autodamp'])
+		self.guessfn=str(chk['guessfn'])
+		self.termination=str(chk['termination'])
+		self.endE=float(chk['endE'])
+		if ('maxdispl' in chk):
+			self.maxdispl=float(chk['maxdispl'])
+			self.nrejected=int(chk['nrejected'])
+		self.lscurv=float(chk['lscurv'])
+		self.lspred=float(chk['lspred'])
+		self.lstrusted=bool(chk['lstrusted'])
+		self.hpcref=None
+		if ('hpc_q' in chk):
+			self.hpcref=(chk['hpc_q'],float(chk['hpc_E']),chk['hpc_g'],chk['hpc_H'])
+		if ('ml_x' in chk) and (self.backendname=='multilevel'):
+			self.backend.ref=(chk['ml_x'],float(chk['ml_dE']),chk['ml_dg'])
+		self.gradhist.clear()
+		if ('hist_x' in chk):
+			self.gradhist.extend(zip(chk['hist_x'],chk['hist_E'],chk['hist_g']))
+	def AnalyticHessian(self):
+		#Hessian, modes and masses for the analytic backends
+		self.mass=np.array([ATOMMASS.get(s,1.0) for s in self.geometry.symbols])
+		self.hessian=self.backend.hessian(self.geometry)
+		sqm=np.sqrt(np.repeat(self.mass,3))
+		w,modes=np.linalg.eigh(self.hessian/np.outer(sqm,sqm))
+		self.modes=modes/sqm[:,None]
+		self.frequencies=np.sign(w)*np.sqrt(np.abs(w))*AU2CM
+		self.energies.append(self.backend.energy(self.geometry))
+		self.SelectMode()
+		self.grad=np.zeros(3*self.natoms) #allocating space for the gradients
 	def ReadHessian(self):
-		#read hessian from hess file 
-		hfile=open(self.hessfn,'r')
-		hdata=hfile.readlines()
-		hfile.close()
-		modes=np.zeros((3*self.natoms,3*self.natoms))
-		energy=0.00
-		modestart=0
-		massstart=0
-		for i in range(len(hdata)):
-			if '$act_energy' in hdata[i]:
-				self.energies.append(float(hdata[i+1]))
-			if '$normal_modes' in hdata[i]:
-				modestart=i+2
-			if '$atoms' in hdata[i]:
-				massstart=i+2
-		done = False
-		i=modestart
-		cols=[0,1,2,3,4,5]
-		while (not done):
-			if '#' in hdata[i]:
-				done=True
-			elif (hdata[i]=='\n'):
-				done=True
-			elif ('.' in hdata[i]):
-				l=hdata[i].split()
-				line=int(l[0])
-				l=list(map(float,l[1:]))
-				modes[line,cols]=l
-			elif (hdata[i].strip != ''):
-				cols=list(map(int,hdata[i].split()))
-			i=i+1
-		done = False
-		i=massstart
-		j=0
-		self.mass=np.zeros(self.natoms)
-		while (not done):
-			if '#' in hdata[i]:
-				done=True
-			elif (hdata[i]=='\n'):
-				done=True
-			elif ('.' in hdata[i]):
-				l=hdata[i].split()
-				self.mass[j]=float(l[1])
-				j += 1
-			i=i+1
-		self.displacement=modes[:,self.mode] 
+		#read the Hessian, normal modes and masses from the hess file
+		hess=readHessFile(self.hessfn)
+		if ('energy' in hess):
+			self.energies.append(float(hess['energy']))
+		self.hessian=hess.get('hessian',np.zeros((3*self.natoms,3*self.natoms))) #Eh/bohr^2
+		self.mass=hess['masses']
+		self.frequencies=hess.get('frequencies')
+		self.modes=hess['modes']
+		self.SelectMode()
 		self.grad=np.zeros(3*self.natoms) #allocating space for the gradients
+	def SelectMode(self,thresh=5.0):
+		#mode to follow: the one in #ircmode or, by default, the imaginary
+		# mode (below -thresh cm-1) of the TS. With several, the one that
+		# overlaps most with the way to the geometry in #irchint is chosen.
+		# Stops (before any calculation) if there is no imaginary mode
+		freqs=self.frequencies
+		if (freqs is None):
+			if (self.mode==None):
+				msg="There are no frequencies in %s, please choose the mode with #ircmode"%(self.hessfn)
+				self.out.write("  %s\n"%(msg))
+				raise SystemExit(msg)
+			self.displacement=self.modes[:,self.mode].copy()
+			return
+		imag=[i for i in range(len(freqs)) if (freqs[i]<-thresh)]
+		if (len(imag)==0) and (not self.restart):
+			msg="There are no imaginary frequencies in %s, so this is not a TS. Stopping before any calculation."%(self.hessfn)
+			self.out.write("  %s\n"%(msg))
+			raise SystemExit(msg)
+		if (self.mode!=None):
+			self.modeinfo.append("chosen in the input, %.2f cm-1"%(freqs[self.mode]))
+			if (self.mode not in imag):
+				self.modeinfo.append("WARNING: this is not an imaginary mode (%s are)"%(', '.join(map(str,imag))))
+		elif (len(imag)==0):
+			self.mode=int(np.argmin(freqs)) #restart from a point that is not a TS
+			self.modeinfo.append("lowest frequency, %.2f cm-1 (restart)"%(freqs[self.mode]))
+		elif (len(imag)==1):
+			self.mode=imag[0]
+			self.modeinfo.append("the imaginary mode, %.2f cm-1"%(freqs[self.mode]))
+		elif (self.hintfn!=''):
+			sqm=np.sqrt(np.repeat(self.mass,3))
+			dq=hintDisplacement(self.geometry,readXYZ(self.hintfn),self.mass)*sqm
+			dq=dq/np.linalg.norm(dq)
+			overlap={}
+			for i in imag:
+				q=self.modes[:,i]*sqm
+				overlap[i]=np.dot(q,dq)/np.linalg.norm(q)
+				self.modeinfo.append("imaginary mode %d, %.2f cm-1, overlap with %s: %.3f"%(i,freqs[i],self.hintfn,overlap[i]))
+			self.mode=max(imag,key=lambda i: abs(overlap[i]))
+			self.modeinfo.append("chosen by its overlap with %s, which lies in direction %+d"%(self.hintfn,np.sign(overlap[self.mode])))
+		else:
+			self.mode=min(imag,key=lambda i: freqs[i])
+			self.modeinfo.append("largest of %d imaginary modes (%s), %.2f cm-1; use #irchint or #ircmode to choose another"%(len(imag),', '.join(map(str,imag)),freqs[self.mode]))
+		self.displacement=self.modes[:,self.mode].copy()
 
-#######################
-# Interface with Orca #
-#######################
+##########################################
+# Interface with the ESS (or a model PES) #
+##########################################
 
-	
-def doEnergy(geo,pars):
-	#run energy calculation -> returns energy
-	name=pars.basename+'.tmp.sp'
-	#os.system("rm %s*"%name) #clean previous calculations with the same name
-	inpfile=open(name+'.inp','w')
-	if (pars.guessfn==""):
-		inpfile.write("! SP\n")
-	else:
-		inpfile.write("! SP MoRead\n%%moinp \"%s\"\n\n"%(pars.guessfn))
-	for line in pars.template:
-		inpfile.write(line)
-	for a in geo:
-		inpfile.write(a.printxyz())
-	inpfile.write("*\n\n")
-	inpfile.close()
-	os.system("%s %s.inp > %s.out"%(pars.orcacmd, name, name))
-	opipe=os.popen("grep 'FINAL SINGLE POINT ENERGY' %s.out"%(name))
-	odata=opipe.readlines()
-	opipe.close()
-	os.system("rm %s*"%name) #clean up
-	return float(odata[-1].split()[-1])
-
-def doGrad(geom,pars):
-	#run gradient calculation -> returns energy and maxgrad
-	# also updates pars.grad vector
-	#os.system("rm %s*"%(name)) #clean previous calculations with the same name
-	name=pars.basename+'.tmp.grd'
-	inpfile=open(name+'.inp','w')
-	newguess=pars.basename+".i4o.last.gbw"
-	if (pars.guessfn==""):
-		inpfile.write("! EnGrad\n")
-	else:
-		inpfile.write("! EnGrad MoRead\n%%moinp \"%s\"\n\n"%(pars.guessfn))
-	for line in pars.template:
-		inpfile.write(line)
-	for a in geom:
-		inpfile.write(a.printxyz())
-	inpfile.write("*\n\n")
-	inpfile.close()
-	os.system("%s %s.inp"%(pars.orcacmd, name))
-	os.system("mv %s.gbw %s"%(name,newguess))
-	pars.guessfn=newguess
-	ofile=open("%s.out"%(name),'r')
-	odata=ofile.readlines()
+class ESSError(RuntimeError):
+	# a calculation failed, or its output could not be understood
+	pass
+
+class ESSTimeout(ESSError):
+	# a calculation was killed, after pars.timeout, or pars.stall seconds
+	# without output
+	pass
+
+class SCFError(ESSError):
+	# the SCF of a calculation did not converge
+	pass
+
+# settings of each attempt of a calculation, after the first ones failed:
+# (use the guess of the IRC (MoRead)?, keywords added to the method line)
+ESCALATION=[(True,''), (False,''), (False,'SlowConv'), (False,'VerySlowConv SOSCF')]
+
+def runJob(cmd,lname,wdir,timeout=0.0,stall=0.0):
+	#runs cmd lname.inp in wdir, and kills it (with everything it started)
+	# if it takes longer than timeout, or if lname.out does not grow for
+	# stall seconds -> exit code, last line of its stderr (in lname.err),
+	# and why it was killed (None if it ended by itself)
+	outname=os.path.join(wdir,lname+'.out')
+	efile=open(os.path.join(wdir,lname+'.err'),'w+')
+	job=subprocess.Popen([cmd,lname+'.inp'],cwd=wdir,stdout=subprocess.DEVNULL,stderr=efile,start_new_session=True)
+	t0=time.time()
+	grown=(t0,-1) #last time the output changed, and its size
+	killed=None
+	try:
+		while (killed==None):
+			try:
+				job.wait(timeout=1.0)
+				break
+			except subprocess.TimeoutExpired:
+				pass
+			now=time.time()
+			size=-1
+			if os.path.exists(outname):
+				size=os.path.getsize(outname)
+			if (size!=grown[1]):
+				grown=(now,size)
+			if (timeout>0.0) and ((now-t0)>timeout):
+				killed="was killed after %.0f s (#irctimeout)"%(now-t0)
+			elif (stall>0.0) and ((now-grown[0])>stall):
+				killed="was killed after %.0f s without output (#ircstall)"%(now-grown[0])
+	finally:
+		if (job.poll()==None):
+			#the whole process group, as cmd may be a script
+			for sig in (signal.SIGTERM,signal.SIGKILL):
+				try:
+					os.killpg(job.pid,sig)
+					job.wait(timeout=5.0)
+					break
+				except ProcessLookupError:
+					break
+				except subprocess.TimeoutExpired:
+					pass
+		efile.seek(0)
+		err=efile.read().strip().split('\n')[-1]
+		efile.close()
+	return (job.returncode,err,killed)
+
+def describeAttempt(stage):
+	guess,keywords=ESCALATION[min(stage,len(ESCALATION)-1)]
+	desc=[{True:'the guess of the IRC',False:'a new guess'}[guess]]
+	if (keywords!=''):
+		desc.append(keywords)
+	return ', '.join(desc)
+
+def parseOrcaOutput(fname,natoms,needgrad=False,blocksize=65536):
+	#reads an Orca output once, in blocks from the end of the file, up to
+	# the last SCF -> dictionary with the energy, RMS gradient, Cartesian
+	# gradient (Eh/bohr), and the number of cycles and convergence of the SCF
+	res={'energy':None, 'rms':None, 'grad':None, 'scf_cycles':None, 'scf_converged':None}
+	ofile=open(fname,'rb')
+	ofile.seek(0,2)
+	pos=ofile.tell()
+	tail=b''
+	lines=[] #in reverse order
+	done=False
+	while (pos>0) and (not done):
+		n=min(blocksize,pos)
+		pos -= n
+		ofile.seek(pos)
+		data=(ofile.read(n)+tail).split(b'\n')
+		tail=data[0] #may be incomplete
+		for line in reversed(data[1:]):
+			lines.append(line)
+			if (b'SCF CONVERGED AFTER' in line) or (b'SCF NOT CONVERGED AFTER' in line):
+				done=True #everything we need is after the last SCF
+				break
+	if (not done):
+		lines.append(tail)
 	ofile.close()
+	grad=np.zeros(3*natoms)
 	ingrad=False
 	atom=0
-	for line in odata:
-		if (ingrad) and ':' in line:
-			ldata=line.split()
-			ldata=list(map(float,ldata[-3:]))
-			s=3*atom
-			e=s+3
-			pars.grad[s:e]=ldata
-			atom=atom+1
-		if 'CARTESIAN GRADIENT' in line:
+	for line in reversed(lines):
+		line=line.decode('utf8','replace')
+		if ('SCF CONVERGED AFTER' in line) or ('SCF NOT CONVERGED AFTER' in line):
+			res['scf_converged']=('NOT' not in line)
+			res['scf_cycles']=int(line.split('AFTER')[1].split()[0])
+		elif 'FINAL SINGLE POINT ENERGY' in line:
+			res['energy']=float(line.split()[-1])
+		elif 'CARTESIAN GRADIENT' in line:
 			ingrad=True
-		if (atom>=pars.natoms):
-			break
-	op=os.popen("grep 'RMS gradient' %s.out"%(name))
-	od=op.readlines()
-	op.close()
-	maxgrad=float(od[-1].split()[-1])
-	op=os.popen("grep 'FINAL SINGLE POINT ENERGY' %s.out"%(name))
-	od=op.readlines()
-	op.close()
-	energy=float(od[-1].split()[-1])
-	os.system("rm %s*"%(name)) #clean previous calculations with the same name
+			atom=0
+		elif ingrad and (':' in line):
+			grad[3*atom:3*atom+3]=list(map(float,line.split()[-3:]))
+			atom += 1
+			if (atom>=natoms):
+				ingrad=False
+				res['grad']=grad.copy()
+		elif 'RMS gradient' in line:
+			res['rms']=float(line.split()[-1])
+	if (needgrad and (res['rms']==None) and (res['grad'] is not None)):
+		res['rms']=np.sqrt(np.mean(res['grad']*res['grad']))
+	return res
+
+def hessMatrix(lines):
+	#matrix printed in blocks of columns, as in hess files (the first line
+	# has its dimensions)
+	dims=list(map(int,lines[0].split()))
+	nrows=dims[0]
+	matrix=np.zeros((nrows,dims[-1]))
+	for k in range(1,len(lines),nrows+1):
+		cols=np.array(lines[k].split(),dtype=int)
+		rows=np.array(''.join(lines[k+1:k+1+nrows]).split(),dtype=float).reshape((nrows,-1))
+		matrix[np.ix_(rows[:,0].astype(int),cols)]=rows[:,1:]
+	return matrix
+
+def readHessFile(fname,cache=True):
+	#reads the blocks of an Orca hess file in one pass -> dictionary with the
+	# energy, Hessian (Eh/bohr^2), frequencies (cm-1, negative if imaginary),
+	# normal modes (columns), symbols, masses (amu) and coordinates (bohr).
+	# The arrays are kept in fname.npz, and read from there while the hess
+	# file does not change
+	npzname=fname+'.npz'
+	st=os.stat(fname)
+	stamp=np.array([st.st_size,st.st_mtime])
+	if (cache and os.path.exists(npzname)):
+		try:
+			data=np.load(npzname)
+			if np.array_equal(data['stamp'],stamp):
+				hess=dict([(k,data[k]) for k in data.files])
+				data.close()
+				return hess
+			data.close()
+		except (OSError,ValueError,KeyError):
+			pass #unreadable cache, parse the hess file again
+	blocks={}
+	name=None
+	hfile=open(fname,'r')
+	for line in hfile:
+		if line.startswith('$'):
+			name=line.strip()[1:]
+			blocks[name]=[]
+		elif (name!=None) and (line.strip()!='') and (not line.startswith('#')):
+			blocks[name].append(line)
+	hfile.close()
+	hess={'stamp':stamp}
+	if (len(blocks.get('act_energy',[]))>0):
+		hess['energy']=np.array(float(blocks['act_energy'][0]))
+	for name in ('hessian','normal_modes'):
+		if (len(blocks.get(name,[]))>0):
+			hess[{'hessian':'hessian','normal_modes':'modes'}[name]]=hessMatrix(blocks[name])
+	if (len(blocks.get('vibrational_frequencies',[]))>0):
+		lines=blocks['vibrational_frequencies']
+		hess['frequencies']=np.array(''.join(lines[1:]).split(),dtype=float).reshape((-1,2))[:,1]
+	if (len(blocks.get('atoms',[]))>0):
+		natoms=int(blocks['atoms'][0])
+		atoms=[l.split() for l in blocks['atoms'][1:1+natoms]]
+		hess['symbols']=np.array([a[0] for a in atoms])
+		hess['masses']=np.array([float(a[1]) for a in atoms])
+		hess['coords']=np.array([list(map(float,a[2:5])) for a in atoms])
+	if (cache):
+		try:
+			nfile=open(npzname+'.tmp','wb')
+			np.savez(nfile,**hess)
+			nfile.close()
+			os.replace(npzname+'.tmp',npzname)
+		except OSError:
+			pass #e.g., a read-only directory
+	return hess
+
+def writeHessFile(fname,geo,mass,energy,H,freqs,modes):
+	#writes an Orca hess file, with the blocks read by readHessFile (and by
+	# Orca, e.g. with InHess Read) -> H in Eh/bohr^2, modes in columns
+	def matrix(M,dims):
+		lines=[dims]
+		for k in range(0,M.shape[1],5):
+			cols=range(k,min(k+5,M.shape[1]))
+			lines.append('  '+''.join(["%19d"%(j) for j in cols])+'\n')
+			for i in range(M.shape[0]):
+				lines.append("%5d   "%(i)+''.join(["%19.10E"%(M[i,j]) for j in cols])+'\n')
+		return ''.join(lines)
+	hfile=open(fname,'w')
+	hfile.write("\n$orca_hessian_file\n\n$act_energy\n%16.6f\n\n"%(energy))
+	hfile.write("$hessian\n%s\n"%(matrix(H,"%d\n"%(len(H)))))
+	hfile.write("$vibrational_frequencies\n%d\n"%(len(freqs)))
+	for i in range(len(freqs)):
+		hfile.write("%5d%16.6f\n"%(i,freqs[i]))
+	hfile.write("\n$normal_modes\n%s\n"%(matrix(modes,"%d %d\n"%modes.shape)))
+	hfile.write("#\n# The atoms: label  mass x y z (in bohrs)\n#\n$atoms\n%d\n"%(len(geo)))
+	for s,m,x in zip(geo.symbols,mass,geo.coords/BOHR):
+		hfile.write(" %-2s%13.5f%20.12f%19.12f%19.12f\n"%(s,m,x[0],x[1],x[2]))
+	hfile.write("\n$end\n\n")
+	hfile.close()
+
+class Backend():
+	# interface between the IRC kernel and whatever provides the energies
+	# and gradients. Coordinates are in angs, energies in Eh and gradients
+	# in Eh/bohr, as in Orca.
+	name='undefined'
+	analytic=False
+	def __init__(self,pars):
+		self.pars=pars
+	# The optional info dictionaries may be filled with details about each
+	# calculation (time per phase, SCF cycles, guess) for the event log.
+	def energy(self,geo,info=None):
+		#-> energy
+		raise NotImplementedError
+	def energy_gradient(self,geo,info=None):
+		#-> energy, gradient (3N array) and RMS gradient
+		raise NotImplementedError
+	def energies(self,geos,infos=None):
+		if (infos==None):
+			infos=[None]*len(geos)
+		return [self.energy(g,i) for g,i in zip(geos,infos)]
+	def energy_gradients(self,geos,infos=None):
+		if (infos==None):
+			infos=[None]*len(geos)
+		return [self.energy_gradient(g,i) for g,i in zip(geos,infos)]
+	def describe(self):
+		return "analytic surface: %s"%(self.name)
+	def hessian(self,geo,h=1.0e-3):
+		#central differences of the gradients -> Hessian in Eh/bohr^2
+		return centralHessian(geo,h,lambda geos: [r[1] for r in self.energy_gradients(geos)])
+
+class OrcaBackend(Backend):
+	# runs Orca through #orcacmd, using the template and guess in pars
+	name='orca'
+	def __init__(self,pars,template=None,level=None):
+		#a level other than None uses its own template and guess (multi-level)
+		Backend.__init__(self,pars)
+		self.template=template
+		self.level=level
+		self.guessfn=''
+	def describe(self):
+		return "Orca from: %s"%(self.pars.orcacmd)
+	def run(self,kind,geo,tag=None,info=None,attempt=0,stage=None):
+		#writes and runs an Orca input in a new directory in the scratch
+		# -> name of the output (without extension) and the directory.
+		# The tag (if any) is added to the name of the input, and the
+		# settings of the attempt are taken from ESCALATION[stage] (by
+		# default, the number of the attempt)
+		if (stage==None):
+			stage=attempt
+		pars=self.pars
+		t0=time.time()
+		lname=os.path.basename(pars.basename)+'.tmp.%s'%({'SP':'sp','EnGrad':'grd'}[kind])
+		if (self.level!=None):
+			lname += '.%s'%(self.level)
+		if (tag!=None):
+			lname += '.%s'%(tag)
+		wdir=pars.scratch.jobdir(lname)
+		name=os.path.join(wdir,lname)
+		guess=pars.guessfn
+		template=pars.template
+		if (self.level!=None):
+			guess=self.guessfn
+			template=self.template
+		useguess,keywords=ESCALATION[min(stage,len(ESCALATION)-1)]
+		if (not useguess):
+			guess=""
+		moinp=""
+		if (guess!=""):
+			guess=os.path.abspath(guess)
+			moinp=guess
+			if (pars.spool!=None):
+				#the job goes to another node with everything it needs
+				moinp=lname+'.guess.gbw'
+				shutil.copyfile(guess,os.path.join(wdir,moinp))
+		cmd=pars.orcacmd
+		if os.path.exists(cmd):
+			cmd=os.path.abspath(cmd)
+		inpfile=open(name+'.inp','w')
+		if (keywords!=""):
+			kind += ' '+keywords
+		if (moinp==""):
+			inpfile.write("! %s\n"%(kind))
+		else:
+			inpfile.write("! %s MoRead\n%%moinp \"%s\"\n\n"%(kind,moinp))
+		for line in template:
+			inpfile.write(line)
+		inpfile.write(geo.printxyz(10))
+		inpfile.write("*\n\n")
+		inpfile.close()
+		t1=time.time()
+		if (pars.slots!=None):
+			pars.slots.acquire(pars.priority)
+		t2=time.time()
+		# orcacmd writes the output to name.out
+		try:
+			if (pars.spool!=None):
+				returncode,err=self.dispatch(cmd,lname,wdir,info)
+			else:
+				returncode,err=self.execute(cmd,lname,wdir)
+		except ESSError:
+			self.cleanup(name,wdir)
+			raise
+		finally:
+			if (pars.slots!=None):
+				pars.slots.release()
+		if (info!=None):
+			info['guess']='none'
+			if (guess!=""):
+				info['guess']=guess
+			info['phases']=collections.OrderedDict([('write',t1-t0),('wait',t2-t1),('run',time.time()-t2)])
+			if (attempt>0):
+				info['attempt']=attempt
+		if (returncode!=0):
+			self.cleanup(name,wdir)
+			raise ESSError("%s %s.inp exited with code %d: %s"%(cmd,lname,returncode,err))
+		return (name,wdir)
+	def execute(self,cmd,lname,wdir):
+		#runs orcacmd in wdir (see runJob) -> exit code and last line of
+		# its stderr
+		returncode,err,killed=runJob(cmd,lname,wdir,self.pars.timeout,self.pars.stall)
+		if (killed!=None):
+			raise ESSTimeout("%s %s.inp %s"%(cmd,lname,killed))
+		return (returncode,err)
+	def dispatch(self,cmd,lname,wdir,info=None):
+		#runs orcacmd on an irc4orca.py --worker, through the spool -> exit
+		# code and last line of its stderr
+		pars=self.pars
+		jobid=pars.spool.submit(wdir,cmd,lname,pars.timeout,pars.stall)
+		status=pars.spool.wait(jobid,wdir)
+		if (info!=None):
+			info['worker']=status['worker']
+		if (status['killed']!=None):
+			raise ESSTimeout("%s %s.inp %s"%(cmd,lname,status['killed']))
+		return (status['returncode'],status['error'])
+	def calculate(self,kind,geo,tag=None,info=None):
+		#runs a calculation and reads its output, trying again with the
+		# settings in ESCALATION (up to pars.retries times) if it fails or
+		# its SCF does not converge -> results of parse, and the name and
+		# directory of the calculation (removed by the caller). The stages
+		# of ESCALATION that would run the same input again (a new guess,
+		# when there was no guess) are skipped
+		pars=self.pars
+		guess=pars.guessfn
+		if (self.level!=None):
+			guess=self.guessfn
+		def settings(stage):
+			useguess,keywords=ESCALATION[min(stage,len(ESCALATION)-1)]
+			return (useguess and (guess!=''),keywords)
+		stage=0
+		for attempt in range(pars.retries+1):
+			t0=time.time()
+			try:
+				name,wdir=self.run(kind,geo,tag,info,attempt,stage)
+				try:
+					res=self.parse(name,len(geo),(kind=='EnGrad'),info)
+					if (res['scf_converged']==False):
+						raise SCFError("the SCF of %s.inp did not converge"%(os.path.basename(name)))
+				except ESSError:
+					self.cleanup(name,wdir)
+					raise
+				if (attempt>0):
+					with pars.lock:
+						pars.nrecovered += 1
+				return (res,name,wdir)
+			except ESSError as err:
+				with pars.lock:
+					pars.nfailed += 1
+				if (pars.events!=None):
+					pars.events.record(pars,'failure',geo,t0,time.time()-t0,'off',{'error':str(err),'attempt':attempt,'calculation':kind})
+				if (attempt>=pars.retries):
+					pars.out.write("   ESS failure: %s; giving up\n"%(err))
+					raise
+				failed=settings(stage)
+				stage += 1
+				while (stage<(len(ESCALATION)-1)) and (settings(stage)==failed):
+					stage += 1
+				pars.out.write("   ESS failure: %s; trying again with %s\n"%(err,describeAttempt(stage)))
+	def cleanup(self,name,wdir,info=None):
+		t0=time.time()
+		shutil.rmtree(wdir,ignore_errors=True)
+		if (info!=None):
+			info['phases']['cleanup']=time.time()-t0
+	def parse(self,name,natoms,needgrad,info=None):
+		#reads the output once -> energy, gradient and RMS gradient
+		t0=time.time()
+		res=parseOrcaOutput(name+'.out',natoms,needgrad)
+		if (res['energy']==None) or (needgrad and (res['rms']==None)):
+			raise ESSError("no %s found in %s.out"%({True:'gradient',False:'energy'}[needgrad],name))
+		if (info!=None):
+			info['scf_cycles']=res['scf_cycles']
+			info['scf_converged']=res['scf_converged']
+			info['phases']['parse']=time.time()-t0
+		return res
+	def energy(self,geo,info=None,tag=None):
+		res,name,wdir=self.calculate('SP',geo,tag,info)
+		self.cleanup(name,wdir,info)
+		return res['energy']
+	def energies(self,geos,infos=None):
+		# up to pars.workers Orca processes are run at the same time
+		if (infos==None):
+			infos=[None]*len(geos)
+		if ((self.pars.workers<2) or (len(geos)<2)):
+			return [self.energy(g,i) for g,i in zip(geos,infos)]
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.pars.workers) as pool:
+			jobs=[pool.submit(self.energy,geos[k],infos[k],str(k)) for k in range(len(geos))]
+			return [j.result() for j in jobs]
+	def energy_gradient(self,geo,info=None,tag=None):
+		# the gbw of untagged calculations becomes the guess for the next ones
+		pars=self.pars
+		res,name,wdir=self.calculate('EnGrad',geo,tag,info)
+		try:
+			if (tag==None) and os.path.exists(name+'.gbw'):
+				newguess=pars.lastGuess(self.level)
+				shutil.move(name+'.gbw',newguess)
+				if (self.level!=None):
+					self.guessfn=newguess
+				else:
+					pars.guessfn=newguess
+					if (info!=None):
+						info['gbw']=newguess
+		finally:
+			self.cleanup(name,wdir,info)
+		return (res['energy'], res['grad'], res['rms'])
+	def energy_gradients(self,geos,infos=None):
+		if (infos==None):
+			infos=[None]*len(geos)
+		if ((self.pars.workers<2) or (len(geos)<2)):
+			return [self.energy_gradient(geos[k],infos[k],'g%d'%(k)) for k in range(len(geos))]
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.pars.workers) as pool:
+			jobs=[pool.submit(self.energy_gradient,geos[k],infos[k],'g%d'%(k)) for k in range(len(geos))]
+			return [j.result() for j in jobs]
+
+class MullerBrownBackend(Backend):
+	# Muller-Brown surface (Theor. Chim. Acta 53, 75) for the x and y
+	# coordinates of the first atom (angs), in kcal/mol, plus a harmonic
+	# well along z. Saddle points at (-0.822,0.624) and (0.212,0.293).
+	name='mullerbrown'
+	analytic=True
+	A=np.array([-200.0,-100.0,-170.0,15.0])
+	a=np.array([-1.0,-1.0,-6.5,0.7])
+	b=np.array([0.0,0.0,11.0,0.6])
+	c=np.array([-10.0,-10.0,-6.5,0.7])
+	x0=np.array([1.0,0.0,-0.5,-1.0])
+	y0=np.array([0.0,0.5,1.5,1.0])
+	kz=0.1 # Eh/angs^2
+	def energy_gradient(self,geo,info=None):
+		x,y,z=geo.coords[0]
+		dx=x-self.x0
+		dy=y-self.y0
+		t=self.A*np.exp((self.a*dx*dx)+(self.b*dx*dy)+(self.c*dy*dy))
+		grad=np.zeros(3*len(geo))
+		grad[0]=np.sum(t*((2.0*self.a*dx)+(self.b*dy)))/627.5095
+		grad[1]=np.sum(t*((self.b*dx)+(2.0*self.c*dy)))/627.5095
+		grad[2]=self.kz*z
+		grad *= BOHR
+		energy=(np.sum(t)/627.5095)+(0.5*self.kz*z*z)
+		return (energy, grad, np.sqrt(np.mean(grad*grad)))
+	def energy(self,geo,info=None):
+		return self.energy_gradient(geo)[0]
+
+class MorseBackend(Backend):
+	# cluster of atoms bound by Morse pair potentials,
+	# V(r)=De*(exp(-2a(r-re))-2exp(-a(r-re))), with De in Eh, a in 1/angs and
+	# re in angs
+	name='morse'
+	analytic=True
+	De=0.01
+	alpha=1.5
+	re=1.5
+	def energy_gradient(self,geo,info=None):
+		xyz=geo.coords
+		rij=xyz[:,None,:]-xyz[None,:,:]
+		r=np.sqrt(np.sum(rij*rij,axis=2))
+		iu=np.triu_indices(len(geo),1)
+		ex=np.exp(-self.alpha*(r[iu]-self.re))
+		energy=self.De*np.sum((ex*ex)-(2.0*ex))
+		dVdr=np.zeros(r.shape)
+		dVdr[iu]=2.0*self.De*self.alpha*(ex-(ex*ex))
+		dVdr=dVdr+dVdr.T
+		np.fill_diagonal(r,1.0)
+		grad=np.sum((dVdr/r)[:,:,None]*rij,axis=1).flatten()*BOHR
+		return (energy, grad, np.sqrt(np.mean(grad*grad)))
+	def energy(self,geo,info=None):
+		return self.energy_gradient(geo)[0]
+
+class MultiLevelBackend(Backend):
+	# Orca at two levels of theory. The energies and gradients of the low
+	# level (pars.lowtemplate) are corrected by the difference to the high
+	# level (pars.template) at the last point xr where both were computed:
+	#   E(x)=El(x)+dE+dg.(x-xr) and g(x)=gl(x)+dg
+	# The first pars.highpts points are done at the high level only, and the
+	# correction is computed again whenever a gradient is needed more than
+	# pars.highdist (angs) away from xr.
+	name='multilevel'
+	def __init__(self,pars):
+		Backend.__init__(self,pars)
+		self.high=OrcaBackend(pars)
+		self.low=OrcaBackend(pars,pars.lowtemplate,'low')
+		self.ref=None #xr (angs), dE (Eh) and dg (Eh/bohr)
+		self.nhigh=0
+		self.nlow=0
+		self.nref=0
+	def describe(self):
+		return "Orca from: %s, at two levels of theory"%(self.pars.orcacmd)
+	def highonly(self):
+		return (self.pars.point<self.pars.highpts) or (self.ref==None)
+	def correct(self,geo,energy,grad=None):
+		#low-level energy (and gradient) -> corrected ones
+		xr,dE,dg=self.ref
+		dx=(geo.flat()-xr)/BOHR
+		energy=energy+dE+np.dot(dg,dx)
+		if (grad is None):
+			return energy
+		return (energy,grad+dg)
+	def energy(self,geo,info=None):
+		return self.energies([geo],[info])[0]
+	def energies(self,geos,infos=None):
+		if (infos==None):
+			infos=[None]*len(geos)
+		if self.highonly():
+			self.nhigh += len(geos)
+			energies=self.high.energies(geos,infos)
+			level='high'
+		else:
+			self.nlow += len(geos)
+			energies=[self.correct(g,E) for g,E in zip(geos,self.low.energies(geos,infos))]
+			level='low'
+		for info in infos:
+			if (info!=None):
+				info['level']=level
+		return energies
+	def energy_gradient(self,geo,info=None):
+		x=geo.flat().copy()
+		if (self.pars.point<self.pars.highpts):
+			self.nhigh += 1
+			res=self.high.energy_gradient(geo,info)
+			level='high'
+		elif (self.ref!=None) and (np.linalg.norm(x-self.ref[0])<=self.pars.highdist):
+			self.nlow += 1
+			energy,grad,rms=self.low.energy_gradient(geo,info)
+			energy,grad=self.correct(geo,energy,grad)
+			res=(energy,grad,np.sqrt(np.mean(grad*grad)))
+			level='low'
+		else:
+			#new correction, from both levels at this point
+			self.nhigh += 1
+			self.nlow += 1
+			self.nref += 1
+			infos=[{},{}]
+			if (self.pars.workers>1):
+				with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+					jobs=[pool.submit(self.high.energy_gradient,geo,infos[0]),pool.submit(self.low.energy_gradient,geo,infos[1])]
+					res,low=[j.result() for j in jobs]
+			else:
+				res=self.high.energy_gradient(geo,infos[0])
+				low=self.low.energy_gradient(geo,infos[1])
+			self.ref=(x,res[0]-low[0],res[1]-low[1])
+			if (info!=None):
+				info.update(infos[1])
+				info.update(infos[0])
+				info['phases']=collections.OrderedDict()
+				for part in infos:
+					for k,v in part.get('phases',{}).items():
+						info['phases'][k]=info['phases'].get(k,0.0)+v
+			level='both'
+		if (info!=None):
+			info['level']=level
+		return res
+	def summary(self):
+		return "  Multi-level: %d high-level and %d low-level calculations, %d corrections\n"%(self.nhigh,self.nlow,self.nref)
+
+BACKENDS={'orca':OrcaBackend, 'mullerbrown':MullerBrownBackend, 'morse':MorseBackend,
+	'multilevel':MultiLevelBackend}
+
+def doEnergy(geo,pars):
+	#run energy calculation -> returns energy
+	return doEnergies([geo],pars)[0]
+
+def doEnergies(geos,pars):
+	#run independent energy calculations -> returns a list of energies
+	# (the backend may run them at the same time)
+	energies=[None]*len(geos)
+	todo=[]
+	for k in range(len(geos)):
+		if (pars.cache!=None):
+			t0=time.time()
+			hit=pars.cache.get(geos[k])
+			if (hit!=None):
+				energies[k]=hit['energy']
+				if (pars.events!=None):
+					pars.events.record(pars,'energy',geos[k],t0,time.time()-t0,'hit',{})
+				continue
+		todo.append(k)
+	if (len(todo)>0):
+		infos=[{} for k in todo]
+		t0=time.time()
+		new=pars.backend.energies([geos[k] for k in todo],infos)
+		elapsed=time.time()-t0
+		with pars.lock:
+			pars.nenergy += len(todo)
+			pars.esstime += elapsed
+		for k,energy,info in zip(todo,new,infos):
+			energies[k]=energy
+			if (pars.cache!=None):
+				pars.cache.put(geos[k],energy)
+			if (pars.events!=None):
+				duration=sum(info.get('phases',{'all':elapsed/len(todo)}).values())
+				info['energy']=energy
+				pars.events.record(pars,'energy',geos[k],t0,duration,cacheStatus(pars.cache),info)
+	if (pars.surrogate!=None):
+		for k in range(len(geos)):
+			pars.surrogate.add(geos[k],energies[k])
+	return energies
+
+def doGrad(geom,pars,backend=None):
+	#run gradient calculation -> returns energy and maxgrad
+	# also updates pars.grad vector, and keeps both in pars.gradhist. The
+	# cache only holds results of pars.backend, and is not used with another
+	cache=pars.cache
+	if (backend==None):
+		backend=pars.backend
+	else:
+		cache=None
+	t0=time.time()
+	if (cache!=None):
+		hit=cache.get(geom,True)
+		if (hit!=None):
+			pars.grad[:]=hit['grad']
+			if (hit['gbw']!=None) and os.path.exists(hit['gbw']):
+				newguess=pars.lastGuess()
+				shutil.copyfile(hit['gbw'],newguess)
+				pars.guessfn=newguess
+			if (pars.events!=None):
+				pars.events.record(pars,'gradient',geom,t0,time.time()-t0,'hit',{})
+			if (pars.surrogate!=None):
+				pars.surrogate.add(geom,hit['energy'],pars.grad)
+			pars.gradhist.append((geom.flat().copy(),hit['energy'],pars.grad.copy()))
+			return (hit['energy'], hit['rms'])
+	info={}
+	t0=time.time()
+	energy,grad,maxgrad=backend.energy_gradient(geom,info)
+	elapsed=time.time()-t0
+	with pars.lock:
+		pars.ngrad += 1
+		pars.esstime += elapsed
+	pars.grad[:]=grad
+	if (cache!=None):
+		cache.put(geom,energy,pars.grad,maxgrad,info.get('gbw'))
+	if (pars.events!=None):
+		info['energy']=energy
+		info['rms_gradient']=maxgrad
+		pars.events.record(pars,'gradient',geom,t0,elapsed,cacheStatus(cache),info)
+	if (pars.surrogate!=None):
+		pars.surrogate.add(geom,energy,pars.grad)
+	pars.gradhist.append((geom.flat().copy(),energy,pars.grad.copy()))
 	return (energy, maxgrad)
 
+def doGrads(geos,pars,backend=None):
+	#run independent gradient calculations -> returns a list of (energy,
+	# gradient, RMS gradient). The backend may run them at the same time,
+	# and they do not change the guess or pars.grad
+	cache=pars.cache
+	if (backend==None):
+		backend=pars.backend
+	else:
+		cache=None
+	results=[None]*len(geos)
+	todo=[]
+	for k in range(len(geos)):
+		if (cache!=None):
+			t0=time.time()
+			hit=cache.get(geos[k],True)
+			if (hit!=None):
+				results[k]=(hit['energy'],hit['grad'].copy(),hit['rms'])
+				if (pars.events!=None):
+					pars.events.record(pars,'gradient',geos[k],t0,time.time()-t0,'hit',{})
+				continue
+		todo.append(k)
+	if (len(todo)>0):
+		infos=[{} for k in todo]
+		t0=time.time()
+		new=backend.energy_gradients([geos[k] for k in todo],infos)
+		elapsed=time.time()-t0
+		with pars.lock:
+			pars.ngrad += len(todo)
+			pars.esstime += elapsed
+		for k,res,info in zip(todo,new,infos):
+			results[k]=res
+			if (cache!=None):
+				cache.put(geos[k],res[0],res[1],res[2])
+			if (pars.events!=None):
+				duration=sum(info.get('phases',{'all':elapsed/len(todo)}).values())
+				info['energy']=res[0]
+				info['rms_gradient']=res[2]
+				pars.events.record(pars,'gradient',geos[k],t0,duration,cacheStatus(cache),info)
+	return results
+
+def cacheStatus(cache):
+	if (cache==None):
+		return 'off'
+	return 'miss'
+
 ######################################
 # Geometry manipulation and printing #
 ######################################
 
 def geodisplace(geo, pars, dvec):
 	#adjust geo for displacement dvec
-	displace=dvec
-	newgeo=[]
-	for i in geo:
-		newgeo.append(Atom(i.printxyz()))
-	i=0
-	for a in newgeo:
-		a.coords[0] += displace[i]
-		a.coords[1] += displace[i+1]
-		a.coords[2] += displace[i+2]
-		i += 3
-	return newgeo
-
-def printTrj(params,n):
-	trj=open(params.basename+'.trj','a')
-	trj.write("%d\nIRC for Orca point %d E=%14.7f\n"%(params.natoms,n,params.energy))
-	for a in params.geometry:
-		trj.write(a.printxyz())
-	trj.close()
+	return Geometry(geo.symbols,geo.coords+np.reshape(dvec,(-1,3)))
+
+def readXYZ(fname):
+	#geometry in an xyz file
+	xfile=open(fname,'r')
+	lines=xfile.readlines()
+	xfile.close()
+	natoms=int(lines[0])
+	atoms=[l.split() for l in lines[2:2+natoms]]
+	return Geometry([a[0] for a in atoms],[list(map(float,a[1:4])) for a in atoms])
+
+def hintDisplacement(ref,geo,mass):
+	#displacement (3N array, angs) from ref to geo, without the translation
+	# and rotation between them (Kabsch)
+	w=mass/np.sum(mass)
+	a=ref.coords-np.dot(w,ref.coords)
+	b=geo.coords-np.dot(w,geo.coords)
+	u,sv,vt=np.linalg.svd(np.dot((b*mass[:,None]).T,a))
+	d=np.sign(np.linalg.det(np.dot(u,vt)))
+	R=np.dot(u*np.array([1.0,1.0,d]),vt)
+	return (np.dot(b,R)-a).reshape(-1)
+
+def printTrj(params,n,rms=0.0,steplen=0.0):
+	#appends the current point to basename.trj (and basename.trj.npy)
+	if (params.algorithm==4):
+		rms=np.sqrt(np.mean(params.grad*params.grad)) #of the interpolated surface, as the energy
+	if (params.trj==None):
+		params.trj=TrjWriter(params.basename+'.trj')
+	params.trj.write(params.geometry,"IRC for Orca point %d E=%14.7f"%(n,params.energy))
+	if (params.usebintrj):
+		if (params.bintrj==None):
+			#opened at the first new point, so params.point is still that of
+			# the checkpoint (0 in a new run)
+			params.bintrj=BinTrjWriter(params.basename+'.trj.npy',params.geometry.symbols,params.point)
+		params.bintrj.write(n,params.geometry,params.energy,params.grad,rms,steplen,params.damp)
+
+################
+# Trajectories #
+################
+
+class TrjReader():
+	# frames of a trj (xyz) file, indexed by their byte offsets. The file is
+	# memory-mapped, and frames are only read and parsed when needed. An
+	# incomplete frame at the end (e.g., from a killed run) is ignored
+	def __init__(self,fname):
+		self.fname=fname
+		self.tfile=open(fname,'rb')
+		self.data=b''
+		if (os.fstat(self.tfile.fileno()).st_size>0):
+			self.data=mmap.mmap(self.tfile.fileno(),0,access=mmap.ACCESS_READ)
+		data=self.data
+		offsets=[]
+		pos=0
+		while True:
+			eol=data.find(b'\n',pos)
+			if (eol<0):
+				break
+			line=data[pos:eol].strip()
+			if (line==b''):
+				pos=eol+1 #blank line between frames
+				continue
+			end=pos
+			for k in range(int(line)+2):
+				end=data.find(b'\n',end)+1
+				if (end==0):
+					break
+			if (end==0):
+				break
+			offsets.append(pos)
+			pos=end
+		self.offsets=np.array(offsets+[pos],dtype=np.int64)
+	def __len__(self):
+		return len(self.offsets)-1
+	def raw(self,i):
+		#text of frame i (bytes)
+		i=range(len(self))[i]
+		return self.data[self.offsets[i]:self.offsets[i+1]]
+	def comment(self,i):
+		i=range(len(self))[i]
+		start=self.data.find(b'\n',self.offsets[i])+1
+		return self.data[start:self.data.find(b'\n',start)].decode('utf8','replace')
+	def energy(self,i):
+		#energy in the comment line of frame i (E=...), or nan
+		comment=self.comment(i)
+		if ('E=' not in comment):
+			return float('nan')
+		return float(comment.split('E=')[1].split()[0])
+	def energies(self):
+		return np.array([self.energy(i) for i in range(len(self))])
+	def geometry(self,i):
+		lines=self.raw(i).decode('utf8').split('\n')
+		natoms=int(lines[0])
+		atoms=[l.split() for l in lines[2:2+natoms]]
+		return Geometry([a[0] for a in atoms],[list(map(float,a[1:4])) for a in atoms])
+	def close(self):
+		if (len(self.data)>0):
+			self.data.close()
+		self.tfile.close()
+
+class TrjWriter():
+	# trj file kept open while the IRC runs. Each frame is flushed as soon
+	# as it is written
+	def __init__(self,fname,mode='a'):
+		self.fname=fname
+		self.tfile=open(fname,mode)
+	def write(self,geo,comment):
+		self.tfile.write("%d\n%s\n%s"%(len(geo),comment,geo.printxyz()))
+		self.tfile.flush()
+	def copy(self,reader,frames):
+		#copies frames (indices) of a TrjReader as they are
+		for i in frames:
+			self.tfile.write(reader.raw(i).decode('utf8'))
+		self.tfile.flush()
+	def close(self):
+		if (not self.tfile.closed):
+			self.tfile.close()
+
+class BinTrjWriter():
+	# binary trajectory: a .npy file with one record per point, which is
+	# appended to as the IRC runs. Each record is written before the header
+	# (with the number of records) is updated, so the file can always be
+	# read with np.load(fname,mmap_mode='r'), even after a crash. With
+	# keep>0 (the last point of the checkpoint, on --resume), the first keep
+	# records of an existing file with the same atoms are kept, and the
+	# rest (e.g., written after the checkpoint) are dropped
+	def __init__(self,fname,symbols,keep=0):
+		natoms=len(symbols)
+		self.fname=fname
+		self.symbols=np.array(symbols,dtype='U3')
+		self.dtype=np.dtype([('point','<i4'),('energy','<f8'),('rms','<f8'),
+			('step','<f8'),('damp','<f8'),('coords','<f8',(natoms,3)),
+			('grad','<f8',(3*natoms,)),('symbols','<U3',(natoms,))])
+		self.descr=np.lib.format.dtype_to_descr(self.dtype)
+		# room in the header for any number of records
+		self.hlen=len(self.header(10**18))
+		self.n=0
+		if (keep>0) and os.path.exists(fname):
+			try:
+				old=np.load(fname,mmap_mode='r')
+				if (old.dtype==self.dtype) and (old.offset==self.hlen):
+					self.n=min(keep,len(old))
+				del old
+			except (OSError,ValueError):
+				pass #not a trajectory of this run, start a new one
+		if (self.n>0):
+			self.bfile=open(fname,'r+b')
+			self.bfile.truncate(self.hlen+(self.n*self.dtype.itemsize))
+			self.bfile.write(self.header(self.n))
+		else:
+			self.bfile=open(fname,'wb')
+			self.bfile.write(self.header(0))
+		self.bfile.seek(0,2)
+	def header(self,n):
+		#npy (v1.0) header for n records, padded to self.hlen bytes
+		d="{'descr': %r, 'fortran_order': False, 'shape': (%d,), }"%(self.descr,n)
+		if hasattr(self,'hlen'):
+			size=self.hlen
+		else:
+			size=64*((len(d)+11+63)//64)
+		return b'\x93NUMPY\x01\x00'+np.uint16(size-10).tobytes()+(d.ljust(size-11)+'\n').encode('latin1')
+	def write(self,point,geo,energy,grad,rms,step,damp):
+		rec=np.zeros(1,dtype=self.dtype)
+		rec['point']=point
+		rec['energy']=energy
+		rec['rms']=rms
+		rec['step']=step
+		rec['damp']=damp
+		rec['coords']=geo.coords
+		rec['grad']=grad
+		rec['symbols']=self.symbols
+		self.bfile.write(rec.tobytes())
+		self.bfile.flush()
+		self.n += 1
+		self.bfile.seek(0)
+		self.bfile.write(self.header(self.n))
+		self.bfile.flush()
+		self.bfile.seek(0,2)
+	def close(self):
+		if (not self.bfile.closed):
+			self.bfile.close()
+
+def mergeTrj(rfn,ffn,ofn):
+	#writes the reverse trajectory backwards followed by the forward one
+	# (a branch that stopped before its first point has no trajectory)
+	out=TrjWriter(ofn,'w')
+	for fname,step in ((rfn,-1),(ffn,1)):
+		if os.path.exists(fname):
+			trj=TrjReader(fname)
+			out.copy(trj,range(len(trj))[::step])
+			trj.close()
+	out.close()
 
 ##############
 # IRC kernel #
 ##############
 
+class Surrogate():
+	# gradient-enhanced Gaussian process (kriging) model of the PES, in
+	# mass-weighted coordinates (bohr amu^(1/2)), fitted to the energies and
+	# gradients of the last pars.surrpts points of the branch. The kernel
+	# is a squared exponential, with the length chosen by maximum likelihood
+	# and the prior mean at the highest energy. Before each new energy is
+	# added, it is compared with the prediction of the model, and the
+	# uncertainty is scaled by the RMS of the last errors (in units of the
+	# predicted uncertainty), so a model that is too confident stops being
+	# used until it improves
+	def __init__(self,pars,jitter=1.0e-8):
+		self.sqm=np.sqrt(np.repeat(pars.mass,3))
+		self.tol=pars.surrtol
+		self.maxpts=pars.surrpts
+		self.jitter=jitter
+		self.data=[] #(x, E, gradient or None)
+		self.model=None
+		self.errors=collections.deque(maxlen=10)
+		self.nasked=0
+		self.npredicted=0
+	def coords(self,geo):
+		return geo.flat()*self.sqm/BOHR
+	def add(self,geo,energy,grad=None):
+		x=self.coords(geo)
+		if (grad is not None):
+			grad=grad/self.sqm
+		for k in range(len(self.data)):
+			if (np.linalg.norm(self.data[k][0]-x)<1.0e-8):
+				if (grad is not None) and (self.data[k][2] is None):
+					self.data[k]=(x,energy,grad.copy())
+					self.model=None
+				return #already known
+		pred=self.predict(x)
+		if (pred!=None):
+			self.errors.append(abs(energy-pred[0])/max(pred[1],1.0e-12))
+		if (grad is not None):
+			grad=grad.copy()
+		self.data.append((x,energy,grad))
+		if (len(self.data)>self.maxpts):
+			del self.data[0]
+		self.model=None
+	def kernel(self,X,Y,ng,l):
+		#covariances (for unit variance) between the energies of Y and the
+		# energies of X and the gradients of the first ng points of X
+		R=X[:,None,:]-Y[None,:,:]
+		k=np.exp(-np.sum(R*R,axis=2)/(2.0*l*l))
+		kg=-(k[:ng,:,None]*R[:ng])/(l*l) # d/dX
+		return np.concatenate([k,kg.transpose(0,2,1).reshape((-1,len(Y)))],axis=0)
+	def covariance(self,X,ng,l):
+		#full covariance matrix (unit variance) of the energies of X and the
+		# gradients of its first ng points
+		d=X.shape[1]
+		R=X[:,None,:]-X[None,:,:]
+		k=np.exp(-np.sum(R*R,axis=2)/(2.0*l*l))
+		n=len(X)+(ng*d)
+		K=np.zeros((n,n))
+		K[:len(X),:len(X)]=k
+		ke=(k[:,:ng,None]*R[:,:ng])/(l*l) #E(a) with dE(b)/dx
+		K[:len(X),len(X):]=ke.reshape((len(X),-1))
+		K[len(X):,:len(X)]=K[:len(X),len(X):].T
+		kgg=k[:ng,:ng,None,None]*((np.eye(d)[None,None,:,:]/(l*l))-(R[:ng,:ng,:,None]*R[:ng,:ng,None,:]/(l**4)))
+		K[len(X):,len(X):]=kgg.transpose(0,2,1,3).reshape((ng*d,ng*d))
+		return K
+	def fit(self):
+		#points with gradients first -> model with the best length
+		data=[p for p in self.data if p[2] is not None]+[p for p in self.data if p[2] is None]
+		ng=len([p for p in data if p[2] is not None])
+		X=np.array([p[0] for p in data])
+		mu=max([p[1] for p in data])
+		y=np.concatenate([[p[1]-mu for p in data]]+[p[2] for p in data[:ng]])
+		#lengths from the distance between neighbouring points
+		dist=[np.linalg.norm(X[k]-X[k-1]) for k in range(1,len(X))]
+		base=max(np.median(dist+[1.0e-3]),1.0e-3)
+		best=None
+		for l in base*(2.0**np.arange(6)):
+			K=self.covariance(X,ng,l)
+			K[np.diag_indices_from(K)] *= (1.0+self.jitter)
+			try:
+				L=np.linalg.cholesky(K)
+			except np.linalg.LinAlgError:
+				continue
+			a=np.linalg.solve(L,y)
+			var=max(np.dot(a,a)/len(y),1.0e-30)
+			logml=-(0.5*len(y)*np.log(var))-np.sum(np.log(np.diag(L)))
+			if (best==None) or (logml>best[0]):
+				best=(logml,l,L,var)
+		if (best==None):
+			return None
+		logml,l,L,var=best
+		alpha=np.linalg.solve(L.T,np.linalg.solve(L,y))
+		return {'X':X, 'ng':ng, 'mu':mu, 'l':l, 'L':L, 'var':var, 'alpha':alpha}
+	def predict(self,x):
+		#-> energy and its uncertainty (standard deviation) at x, or None
+		if (len(self.data)<2):
+			return None
+		if (self.model==None):
+			self.model=self.fit()
+		m=self.model
+		if (m==None):
+			return None
+		ks=self.kernel(m['X'],x[None,:],m['ng'],m['l'])[:,0]
+		v=np.linalg.solve(m['L'],ks)
+		return (m['mu']+np.dot(ks,m['alpha']), np.sqrt(m['var']*max(1.0-np.dot(v,v),0.0)))
+	def energy(self,geo,ref):
+		#-> the predicted energy, or None if it is not reliable enough: its
+		# uncertainty must be below pars.surrtol, and below 5% of its
+		# difference to the energy ref of the line search
+		self.nasked += 1
+		if (len(self.errors)<3):
+			return None #not tested yet
+		pred=self.predict(self.coords(geo))
+		if (pred==None):
+			return None
+		scale=max(1.0,np.sqrt(np.mean(np.array(self.errors)**2)))
+		if (scale*pred[1]>min(self.tol,0.05*abs(pred[0]-ref))):
+			return None
+		self.npredicted += 1
+		return pred[0]
+	def summary(self):
+		frac=0.0
+		if (self.nasked>0):
+			frac=100.0*self.npredicted/self.nasked
+		return "  Surrogate model: %d of %d line-search energies predicted (%.1f%% of the calculations avoided)\n"%(self.npredicted,self.nasked,frac)
+
+def lsEnergies(geos,pars,E1):
+	#energies for the line search from the point with energy E1: from the
+	# surrogate model, when it is reliable enough, and from the ESS for the
+	# others
+	energies=[None]*len(geos)
+	if (pars.surrogate!=None):
+		for k in range(len(geos)):
+			t0=time.time()
+			energies[k]=pars.surrogate.energy(geos[k],E1)
+			if (energies[k]!=None) and (pars.events!=None):
+				pars.events.record(pars,'surrogate',geos[k],t0,time.time()-t0,'model',{'energy':energies[k]})
+	todo=[k for k in range(len(geos)) if energies[k]==None]
+	if (len(todo)>0):
+		for k,E in zip(todo,doEnergies([geos[k] for k in todo],pars)):
+			energies[k]=E
+	return energies
+
+def gradLineSearch(pars,geo1,E1,D):
+	#line search along D from geo1 using E(x)=E1+s*x+c*x^2, in which the
+	# slope s is the directional derivative of the gradient at geo1 and the
+	# curvature c comes from one energy evaluation at pars.delta, or from
+	# the previous step while its predictions were good and the minimum it
+	# predicts is between geo1 and pars.delta (no extrapolation) -> returns
+	# opdelta
+	slope=np.dot(pars.grad,D)/BOHR #gradients are in Eh/bohr
+	D2=np.dot(D,D)
+	if (pars.lstrusted and (pars.lscurv>0.0)):
+		curv=pars.lscurv*D2
+		opdelta=-slope/(2.0*curv)
+		if (0.0<opdelta<=pars.delta):
+			pars.lspred=E1-slope*slope/(4.0*curv)
+			return opdelta
+	geo2=geodisplace(geo1,pars,pars.delta*D)
+	E2=lsEnergies([geo2],pars,E1)[0]
+	curv=(E2-E1-slope*pars.delta)/(pars.delta*pars.delta)
+	if (curv>0.0):
+		pars.lscurv=curv/D2
+		pars.lspred=E1-slope*slope/(4.0*curv)
+		return -slope/(2.0*curv)
+	#no minimum along D in the model: fall back to the fit of algorithm 1
+	if (E2>E1):
+		newdelta=0.5*pars.delta
+	else:
+		newdelta=2.0*pars.delta
+	geo3=geodisplace(geo1,pars,newdelta*D)
+	E3=lsEnergies([geo3],pars,E1)[0]
+	deltaFit=np.polyfit([0.0,pars.delta,newdelta],[E1,E2,E3],deg=2)
+	opdelta=-(deltaFit[1]/(2.0*deltaFit[0]))
+	pars.lscurv=0.0
+	pars.lspred=np.polyval(deltaFit,opdelta)
+	return opdelta
+
 def Morokuma(pars,start=False):
 	#Does a cycle in the Morokuma algorithm, returns the energy and MaxGrad of the
 	# new point
@@ -405,6 +2324,7 @@ def Morokuma(pars,start=False):
 		#	pars.displacement[(3*i)+1] /= np.sqrt(pars.mass[i])
 		#	pars.displacement[(3*i)+2] /= np.sqrt(pars.mass[i])
 		pars.displacement=pars.alpha*(pars.displacement/np.linalg.norm(pars.displacement))
+		pars.laststep=pars.alpha
 		#displace geometry following the normal mode
 		geo1=geodisplace(pars.geometry,pars,pars.displacement)
 		E1,MG1=doGrad(geo1,pars)
@@ -415,11 +2335,9 @@ def Morokuma(pars,start=False):
 	else:
 		#scale down gradients and calculate the displacement
 		pars.displacement=(pars.damp*pars.displacement)-((1.0-pars.damp)*pars.grad)
-		for i in range(len(pars.mass)):
-			pars.displacement[(3*i)] /= np.sqrt(pars.mass[i])
-			pars.displacement[(3*i)+1] /= np.sqrt(pars.mass[i])
-			pars.displacement[(3*i)+2] /= np.sqrt(pars.mass[i])
+		pars.displacement /= np.repeat(np.sqrt(pars.mass),3)
 		pars.displacement=pars.maxdispl*(pars.displacement/np.linalg.norm(pars.displacement))
+		pars.laststep=pars.maxdispl
 		#displace geometry following the gradient
 		geo1=geodisplace(pars.geometry,pars,pars.displacement)
 		E1,MG1=doGrad(geo1,pars)
@@ -428,87 +2346,528 @@ def Morokuma(pars,start=False):
 		D=(pars.displacement/np.linalg.norm(pars.displacement))-(tmpvec/np.linalg.norm(tmpvec))
 	# find the optimum delta that will assure the new point is at the 
 	# local minimum
-	if (pars.algorithm==1):
+	if (pars.algorithm==3):
+		pass #see gradLineSearch
+	elif (pars.algorithm==1):
 		geo2=geodisplace(geo1,pars,pars.delta*D)
-		E2=doEnergy(geo2,pars)
-		if (E2>E1):
-			newdelta=0.5*pars.delta
+		if (pars.workers>1):
+			#speculative: evaluate both candidates for the third point
+			# together with the second one
+			geo3a=geodisplace(geo1,pars,0.5*pars.delta*D)
+			geo3b=geodisplace(geo1,pars,2.0*pars.delta*D)
+			E2,E3a,E3b=lsEnergies([geo2,geo3a,geo3b],pars,E1)
+			if (E2>E1):
+				newdelta=0.5*pars.delta
+				E3=E3a
+			else:
+				newdelta=2.0*pars.delta
+				E3=E3b
 		else:
-			newdelta=2.0*pars.delta
-		geo3=geodisplace(geo1,pars,newdelta*D)
-		E3=doEnergy(geo3,pars)
+			E2=lsEnergies([geo2],pars,E1)[0]
+			if (E2>E1):
+				newdelta=0.5*pars.delta
+			else:
+				newdelta=2.0*pars.delta
+			geo3=geodisplace(geo1,pars,newdelta*D)
+			E3=lsEnergies([geo3],pars,E1)[0]
 		Evals=np.array([E1, E2, E3])
 		Deltavals=np.array([0.0,pars.delta,newdelta])
 	else:
-		geo2=geodisplace(geo1,pars,pars.delta*D)
-		E2=doEnergy(geo2,pars)
 		delta3=0.5*pars.delta
-		geo3=geodisplace(geo1,pars,delta3*D)
-		E3=doEnergy(geo3,pars)
 		delta4=2.0*pars.delta
-		geo4=geodisplace(geo1,pars,delta4*D)
-		E4=doEnergy(geo4,pars)
 		delta5=-0.5*pars.delta
-		geo5=geodisplace(geo1,pars,delta5*D)
-		E5=doEnergy(geo5,pars)
+		geos=[geodisplace(geo1,pars,d*D) for d in (pars.delta,delta3,delta4,delta5)]
+		E2,E3,E4,E5=lsEnergies(geos,pars,E1)
 		Evals=np.array([E1, E2, E3, E4, E5])
 		Deltavals=np.array([0.0,pars.delta,delta3, delta4, delta5])
-	deltaFit=np.polyfit(Deltavals,Evals,deg=2)
-	opdelta=-(deltaFit[1]/(2.0*deltaFit[0]))
+	if (pars.algorithm==3):
+		opdelta=gradLineSearch(pars,geo1,E1,D)
+	else:
+		deltaFit=np.polyfit(Deltavals,Evals,deg=2)
+		opdelta=-(deltaFit[1]/(2.0*deltaFit[0]))
+		pars.lspred=np.polyval(deltaFit,opdelta)
 	# update the geometry to the new point, update and return energy and gradients
 	pars.geos.append(pars.geometry)
 	pars.energies.append(pars.energy)
 	pars.geometry=geodisplace(geo1,pars,opdelta*D)
 	newE, newMaxGrad = doGrad(pars.geometry,pars) 
 	pars.energy=newE
+	if (pars.algorithm==3):
+		#keep using the fitted curvature while it predicts the energy well
+		pars.lstrusted=(abs(newE-pars.lspred)<=max(0.1*abs(newE-E1),1.0e-6))
 	#the following line is just for debugging purposes
 	#print(Evals, Deltavals,np.linalg.norm(pars.displacement), opdelta)
 	return (newE, newMaxGrad)
 
-def ircdrv(inpname):
-	params=ToolKit(inpname)
+def adaptiveStep(pars,start=False):
+	#Morokuma step with its length (pars.maxdispl) adapted to the path: it
+	# grows while the line search predicts the energy of the new point well
+	# and the gradient does not drop quickly (the end of the path is still
+	# far), and shrinks when the prediction gets worse. Successive
+	# displacements are not compared: the line search makes the path zigzag,
+	# so they are nearly perpendicular even where the path is straight.
+	# A point with a higher energy is rejected, and the step is retried with
+	# half the length, down to pars.dmin; once the gradient is close to
+	# pars.tolerance, such a point ends the IRC, as with a fixed step
+	if (start or (len(pars.geos)<2)): #no previous step to compare with
+		return Morokuma(pars,start)
+	state=(pars.displacement.copy(),pars.grad.copy(),pars.geometry,pars.energy,len(pars.geos),pars.lscurv,pars.lstrusted)
+	rms=np.sqrt(np.mean(state[1]*state[1]))
+	rejected=False
+	while True:
+		E,MG=Morokuma(pars,False)
+		fiterr=abs(E-pars.lspred)/max(abs(E-state[3]),1.0e-12)
+		if ((E>state[3]) or (not np.isfinite(E))) and (pars.maxdispl>pars.dmin) and (rms>(10.0*pars.tolerance)):
+			#reject this point, and go back to the previous one
+			pars.displacement,pars.grad[:],pars.geometry,pars.energy=state[0].copy(),state[1],state[2],state[3]
+			del pars.geos[state[4]:]
+			del pars.energies[state[4]:]
+			pars.lscurv,pars.lstrusted=state[5],state[6]
+			pars.nrejected += 1
+			pars.maxdispl=max(pars.dmin,0.5*pars.maxdispl)
+			pars.out.write("   Point rejected (dE=%.2e), new step: %.4f\n"%(E-state[3],pars.maxdispl))
+			rejected=True
+			continue
+		if (fiterr<0.1) and (np.sqrt(np.mean(pars.grad*pars.grad))>(0.5*rms)) and (not rejected):
+			pars.maxdispl=min(pars.dmax,1.5*pars.maxdispl)
+		elif (fiterr>0.3):
+			pars.maxdispl=max(pars.dmin,0.7*pars.maxdispl)
+		return (E,MG)
+
+def hessUpdate(H,dq,dg,method='bofill'):
+	#updated Hessian from a step dq and the change in the gradient dg
+	Hdq=np.dot(H,dq)
+	if (method=='bfgs'):
+		dgdq=np.dot(dg,dq)
+		dqHdq=np.dot(dq,Hdq)
+		if (dgdq<=1.0e-12) or (dqHdq<=1.0e-12):
+			return H #the update would not keep H positive definite
+		return H+(np.outer(dg,dg)/dgdq)-(np.outer(Hdq,Hdq)/dqHdq)
+	#Bofill: mixture of the symmetric rank one and Powell updates
+	xi=dg-Hdq
+	dqdq=np.dot(dq,dq)
+	xidq=np.dot(xi,dq)
+	xixi=np.dot(xi,xi)
+	if (dqdq<1.0e-16) or (xixi<1.0e-16):
+		return H
+	phi=(xidq*xidq)/(xixi*dqdq)
+	psb=((np.outer(xi,dq)+np.outer(dq,xi))/dqdq)-(xidq*np.outer(dq,dq)/(dqdq*dqdq))
+	sr1=np.zeros(H.shape)
+	if (abs(xidq)>1.0e-12):
+		sr1=np.outer(xi,xi)/xidq
+	return H+(phi*sr1)+((1.0-phi)*psb)
+
+def lqaStep(g,H,s):
+	#local quadratic approximation (Page and McIver): displacement along the
+	# steepest descent path of the quadratic model, with arc length s
+	w,U=np.linalg.eigh(H)
+	gt=np.dot(U.T,g)
+	def path(t):
+		#displacement at t along the path of the model
+		tw=np.where(np.abs(w)>1.0e-8,w,1.0)
+		c=np.where(np.abs(w)>1.0e-8,np.expm1(-w*t)/tw,-t)
+		return np.dot(U,gt*c)
+	def arc(t):
+		ts=np.linspace(0.0,t,101)
+		v=np.sqrt(np.sum((gt[:,None]**2)*np.exp(-2.0*np.outer(w,ts)),axis=0))
+		return np.sum(0.5*(v[1:]+v[:-1])*np.diff(ts))
+	gnorm=np.linalg.norm(g)
+	if (gnorm<1.0e-12):
+		return np.zeros(g.shape)
+	tmax=s/gnorm
+	n=0
+	while (arc(tmax)<s) and (n<40):
+		tmax *= 2.0
+		n += 1
+	if (n>=40):
+		return path(tmax) #the minimum of the model is closer than s
+	tmin=0.0
+	for n in range(60):
+		t=0.5*(tmin+tmax)
+		if (arc(t)<s):
+			tmin=t
+		else:
+			tmax=t
+	return path(0.5*(tmin+tmax))
+
+def dwiModel(q,pts):
+	#distance weighted interpolation (Collins et al.) of the quadratic
+	# expansions about the points in pts -> energy and gradient at q
+	T=[]
+	gT=[]
+	v=[]
+	dv=[]
+	for (qi,Ei,gi,Hi) in pts:
+		dq=q-qi
+		d2=np.dot(dq,dq)
+		Hdq=np.dot(Hi,dq)
+		Ti=Ei+np.dot(gi,dq)+0.5*np.dot(dq,Hdq)
+		if (d2<1.0e-16):
+			return (Ti,gi+Hdq)
+		T.append(Ti)
+		gT.append(gi+Hdq)
+		v.append(1.0/(d2*d2))
+		dv.append(-4.0*dq/(d2*d2*d2))
+	S=sum(v)
+	dS=sum(dv)
+	E=0.0
+	grad=np.zeros(q.shape)
+	for i in range(len(v)):
+		wi=v[i]/S
+		dwi=((dv[i]*S)-(v[i]*dS))/(S*S)
+		E += wi*T[i]
+		grad += (dwi*T[i])+(wi*gT[i])
+	return (E,grad)
+
+def HPC(pars,start=False):
+	#Does a cycle of the Hessian-based predictor-corrector integrator
+	# (Hratchian and Schlegel), in mass-weighted coordinates (bohr amu^(1/2)),
+	# returns the energy and RMS gradient computed at the predictor point,
+	# which are used to stop the IRC. The new (corrected) point gets the
+	# energy and gradient of the interpolated surface, for the trajectories
+	sqm=np.sqrt(np.repeat(pars.mass,3))
+	def mwcoords(geo):
+		return geo.flat()*sqm/BOHR
+	if (start):
+		#displace the TS along the normal mode, as in the Morokuma algorithm
+		pars.displacement=float(pars.direction)*pars.displacement
+		pars.displacement=pars.alpha*(pars.displacement/np.linalg.norm(pars.displacement))
+		pars.laststep=pars.alpha
+		pars.geometry=geodisplace(pars.geometry,pars,pars.displacement)
+	if (start or (pars.hpcref==None)):
+		E,MG=doGrad(pars.geometry,pars)
+		Hq=pars.hessian/np.outer(sqm,sqm)
+		pars.hpcref=(mwcoords(pars.geometry),E,pars.grad/sqm,Hq)
+		pars.energy=E
+		if (start):
+			return (E,MG)
+	q0=mwcoords(pars.geometry)
+	qr,Er,gr,Hr=pars.hpcref
+	#gradient at the current point: exact after a gradient calculation,
+	# or from the model after a corrector step
+	g0=pars.grad/sqm
+	#predictor: LQA step on the Hessian of the last computed point
+	dq=lqaStep(g0,Hr,pars.step)
+	pars.laststep=pars.step
+	geop=geodisplace(pars.geometry,pars,dq*BOHR/sqm)
+	Ep,MGp=doGrad(geop,pars)
+	qp=mwcoords(geop)
+	gp=pars.grad/sqm
+	Hp=hessUpdate(Hr,qp-qr,gp-gr,pars.hupdate)
+	pts=[pars.hpcref,(qp,Ep,gp,Hp)]
+	pars.hpcref=pts[1]
+	#corrector: follow the steepest descent path of the interpolated surface
+	nsteps=20
+	h=pars.step/nsteps
+	q=q0.copy()
+	E,g=dwiModel(q,pts)
+	for n in range(nsteps):
+		gnorm=np.linalg.norm(g)
+		if (gnorm<1.0e-10):
+			break
+		Em,gm=dwiModel(q-(0.5*h*g/gnorm),pts)
+		qn=q-(h*gm/np.linalg.norm(gm))
+		En,gn=dwiModel(qn,pts)
+		if (En>E):
+			break #passed the minimum of the model
+		q,E,g=qn,En,gn
+	pars.geos.append(pars.geometry)
+	pars.energies.append(pars.energy)
+	pars.geometry=geodisplace(pars.geometry,pars,(q-q0)*BOHR/sqm)
+	pars.energy=E
+	pars.grad=g*sqm
+	return (Ep,MGp)
+
+#############
+# Endpoints #
+#############
+
+def centralHessian(geo,h,gradients):
+	#Hessian (Eh/bohr^2) from the gradients at the 6N geometries displaced
+	# by +-h (angs) along each coordinate. gradients(geos) -> list of the
+	# gradients, so all of them may be computed at the same time
+	n=3*len(geo)
+	geos=[]
+	for i in range(n):
+		dvec=np.zeros(n)
+		dvec[i]=h
+		geos += [geodisplace(geo,None,dvec), geodisplace(geo,None,-dvec)]
+	grads=gradients(geos)
+	H=np.zeros((n,n))
+	for i in range(n):
+		H[i,:]=(grads[2*i]-grads[(2*i)+1])*BOHR/(2.0*h)
+	return 0.5*(H+H.T)
+
+def rigidModes(geo,weights):
+	#orthonormal basis (columns) of the translations and rotations of geo,
+	# in the coordinates x*weights (e.g., the square roots of the masses)
+	x=geo.coords-np.mean(geo.coords,axis=0)
+	rigid=[]
+	for k in range(3):
+		t=np.zeros((len(geo),3))
+		t[:,k]=1.0
+		rigid.append((t.flatten())*weights)
+		r=np.cross(np.eye(3)[k],x)
+		rigid.append((r.flatten())*weights)
+	u,sv,vt=np.linalg.svd(np.array(rigid).T,full_matrices=False)
+	return u[:,sv>(1.0e-6*sv[0])] #5 for linear molecules
+
+def vibrations(geo,mass,H):
+	#harmonic analysis of H (Eh/bohr^2) -> frequencies (cm-1, negative if
+	# imaginary) and normal modes (columns, normalized Cartesian
+	# displacements), as in Orca hess files: the translations and rotations
+	# are projected out of molecules (not of single atoms, as in the
+	# Muller-Brown surface), and their modes come first, with frequency 0
+	sqm=np.sqrt(np.repeat(mass,3))
+	Hq=H/np.outer(sqm,sqm)
+	nrigid=0
+	if (len(geo)>1):
+		B=rigidModes(geo,sqm)
+		nrigid=B.shape[1]
+		P=np.eye(len(sqm))-np.dot(B,B.T)
+		Hq=np.dot(P,np.dot(Hq,P))
+	w,q=np.linalg.eigh(Hq)
+	if (nrigid>0):
+		#the rigid modes are the ones in the space of B
+		inB=np.sum(np.dot(B.T,q)**2,axis=0)
+		order=np.argsort(-inB)
+		vib=np.sort(order[nrigid:])
+		w=np.concatenate([np.zeros(nrigid),w[vib]])
+		q=np.concatenate([np.zeros((len(sqm),nrigid)),q[:,vib]],axis=1)
+	freqs=np.sign(w)*np.sqrt(np.abs(w))*AU2CM
+	modes=q/sqm[:,None]
+	norms=np.linalg.norm(modes,axis=0)
+	modes[:,norms>0.0] /= norms[norms>0.0]
+	return (freqs,modes)
+
+def endpointHessian(params,thresh=10.0):
+	#numerical Hessian of the last point of a branch, from 6N gradients run
+	# at the same time (with the high level in a multi-level IRC). Reports
+	# the lowest frequencies, and writes basename.end.hess. The optimized
+	# endpoint is used if there is one (see endpointOpt)
+	geo=params.geometry
+	energy=params.endE
+	if (params.optgeo!=None):
+		geo,energy=params.optgeo,params.optE
+	elif (params.termination=='energy increased'):
+		geo=params.geos[-1] #the last accepted point
+	backend=None
+	if (params.backendname=='multilevel'):
+		backend=params.backend.high
+	h=params.endhessstep*BOHR
+	n0=params.ngrad
+	t0=time.time()
+	H=centralHessian(geo,h,lambda geos: [r[1] for r in doGrads(geos,params,backend)])
+	freqs,modes=vibrations(geo,params.mass,H)
+	fname=params.basename+'.end.hess'
+	writeHessFile(fname,geo,params.mass,energy,H,freqs,modes)
+	nrigid=len(freqs)-np.count_nonzero(freqs)
+	vib=freqs[nrigid:]
+	nimag=np.count_nonzero(vib<-thresh)
+	params.out.write("  Endpoint Hessian: %d gradients (%d computed), %.1f s, written to %s\n"%(6*len(geo),params.ngrad-n0,time.time()-t0,fname))
+	params.out.write("  Lowest frequencies (cm-1): %s\n"%(' '.join(["%.2f"%(f) for f in vib[:6]])))
+	if (nimag==0):
+		params.out.write("  No imaginary frequencies (below -%.0f cm-1): the endpoint is a minimum\n"%(thresh))
+	else:
+		params.out.write("  %d imaginary frequencies (below -%.0f cm-1): the endpoint is NOT a minimum\n"%(nimag,thresh))
+	return (freqs,modes)
+
+def warmHessian(params):
+	#starting Hessian (Eh/bohr^2) for endpointOpt: the one updated by HPC
+	# along the path, or the Hessian of the TS updated with the gradients
+	# computed along the branch (params.gradhist)
+	if (params.hpcref!=None):
+		sqm=np.sqrt(np.repeat(params.mass,3))
+		return params.hpcref[3]*np.outer(sqm,sqm)
+	H=params.hessian.copy()
+	hist=list(params.gradhist)
+	for k in range(1,len(hist)):
+		H=hessUpdate(H,(hist[k][0]-hist[k-1][0])/BOHR,hist[k][2]-hist[k-1][2],'bofill')
+	return H
+
+def rfoStep(g,H,trust):
+	#rational function optimization step (bohr) for the gradient g and the
+	# (positive definite) Hessian H, no longer than trust
+	n=len(g)
+	A=np.zeros((n+1,n+1))
+	A[:n,:n]=H
+	A[:n,n]=g
+	A[n,:n]=g
+	w,v=np.linalg.eigh(A)
+	s=v[:n,0]/v[n,0]
+	if (np.linalg.norm(s)>trust):
+		s *= trust/np.linalg.norm(s)
+	return s
+
+def endpointOpt(params,wmin=1.0e-3):
+	#quasi-Newton (RFO with BFGS updates) minimization of the last point of
+	# a branch, with a trust radius, warm-started with the Hessian built
+	# along the IRC (see warmHessian) and the gbw of the last gradient. The
+	# translations and rotations are projected out of the gradient, and
+	# the eigenvalues of the Hessian are made positive, and at least wmin
+	# -> optimized geometry and energy (also in params.optgeo and optE)
+	geo=params.geometry
+	if (params.termination=='energy increased'):
+		geo=params.geos[-1] #the last accepted point
+	backend=None
+	if (params.backendname=='multilevel'):
+		backend=params.backend.high
+	n0=params.ngrad
+	t0=time.time()
+	P=np.eye(3*len(geo))
+	if (len(geo)>1):
+		B=rigidModes(geo,np.ones(3*len(geo)))
+		P -= np.dot(B,B.T)
+	#energy and gradient of the first point: computed along the path?
+	start=None
+	ncalls=0
+	if (params.backendname!='multilevel'):
+		for x,E,g in params.gradhist:
+			if np.array_equal(x,geo.flat()):
+				start=(E,g.copy())
+	if (start==None):
+		E,MG=doGrad(geo,params,backend)
+		start=(E,params.grad.copy())
+		ncalls += 1
+	E,g=start
+	E0=E
+	H=warmHessian(params)
+	H=np.dot(P,np.dot(0.5*(H+H.T),P))
+	w,U=np.linalg.eigh(H)
+	H=np.dot(U*np.maximum(np.abs(w),wmin),U.T)
+	trust=0.3
+	converged=False
+	params.out.write("  Endpoint optimization (RFO, Hessian from the IRC):\n")
+	for cycle in range(params.endoptcycles+1):
+		gp=np.dot(P,g)
+		rms=np.sqrt(np.mean(gp*gp))
+		params.out.write("   opt %3d %20.9f %9.5f %8.4f\n"%(cycle,E,rms,trust))
+		if (rms<params.endopttol) and (np.max(np.abs(gp))<(3.0*params.endopttol)):
+			converged=True
+			break
+		if (cycle==params.endoptcycles):
+			break
+		s=np.dot(P,rfoStep(gp,H,trust))
+		dEpred=np.dot(gp,s)+(0.5*np.dot(s,np.dot(H,s)))
+		newgeo=geodisplace(geo,None,s*BOHR)
+		En,MGn=doGrad(newgeo,params,backend)
+		ncalls += 1
+		gn=params.grad.copy()
+		H=hessUpdate(H,s,np.dot(P,gn-g),'bfgs')
+		ratio=(En-E)/min(dEpred,-1.0e-14)
+		if (En>E):
+			#rejected: try again from the same point, with a shorter step
+			trust=max(0.25*np.linalg.norm(s),1.0e-4)
+			continue
+		if (ratio>0.75) and (np.linalg.norm(s)>(0.8*trust)):
+			trust=min(2.0*trust,0.5)
+		elif (ratio<0.25):
+			trust=max(0.5*trust,1.0e-4)
+		geo,E,g=newgeo,En,gn
+	params.optgeo=geo
+	params.optE=E
+	fname=params.basename+'.end.xyz'
+	out=TrjWriter(fname,'w')
+	out.write(geo,"IRC for Orca optimized endpoint E=%14.7f"%(E))
+	out.close()
+	params.out.write("  Endpoint optimization %s after %d cycles: %d gradients (%d computed), %.1f s\n"%({True:'converged',False:'NOT converged'}[converged],cycle,ncalls,params.ngrad-n0,time.time()-t0))
+	params.out.write("  Optimized endpoint: E=%.9f (%.2e from the IRC), written to %s\n"%(E,E-E0,fname))
+	return (geo,E)
+
+def printHeader(params):
 	params.out.write("""   IRC wrapper for Orca - version 2.0
    by Filipe Teixeira, 
    REQUIMTE
    Faculdade de Ciencias da Universidade do Porto
 
-  Using Orca from: %s 
+  Using %s 
   
-  Parameters for this run: \n"""%(params.orcacmd))
+  Parameters for this run: \n"""%(params.backend.describe()))
 	params.printPars()
+
+def ircbranch(params):
+	#follows the IRC in the direction set in params, from the last
+	# accepted point
+	if (params.finished):
+		params.out.write("  This branch has already finished.\n")
+		return
 	keep=True
-	n=0
-	oldE=0.0
-	params.out.write("   Pt. %20s %9s %10s\n"%('Energy','RMS Grad.','Damp'))
+	n=params.point
+	oldE=params.oldE
+	if (params.algorithm==4):
+		#the values computed at the predictor point of each step
+		params.out.write("   Pt. %20s %9s %10s %8s %4s\n"%('Energy (pred.)','RMS Pred.','Damp','Step','ESS'))
+	else:
+		params.out.write("   Pt. %20s %9s %10s %8s %4s\n"%('Energy','RMS Grad.','Damp','Step','ESS'))
 	params.out.write("------------------------------------------------\n")
+	failed=None #step lengths before a failed step
 	while (keep):
-		if (params.restart or (n>0)):
-			E,MG=Morokuma(params,False)
+		ncalls=params.nenergy+params.ngrad
+		if (params.algorithm==4):
+			step=HPC
+		elif (params.adapt):
+			step=adaptiveStep
 		else:
-			E,MG=Morokuma(params,True)
+			step=Morokuma
+		saved=params.State()
+		try:
+			if (params.restart or (n>0)):
+				E,MG=step(params,False)
+			else:
+				E,MG=step(params,True)
+		except ESSError as err:
+			#back to the last accepted point: try once more with half the
+			# step, and then stop (this branch may be resumed later)
+			params.SetState(saved)
+			if (failed==None):
+				failed=(params.maxdispl,params.step)
+				params.maxdispl *= 0.5
+				params.step *= 0.5
+				params.out.write("   Step failed (%s): trying again from point %d with half the step\n"%(err,n))
+				continue
+			params.maxdispl,params.step=failed
+			params.termination='ess failure'
+			params.out.write("----------------------------------------------\n")
+			params.out.write("--               ESS FAILURE                --\n")
+			params.out.write("--        IRC CALCULATION STOPPED AT        --\n")
+			params.out.write("--  THE LAST POINT (USE --resume TO GO ON)  --\n")
+			params.out.write("----------------------------------------------\n")
+			break
+		steplen=params.laststep #adaptiveStep has already set maxdispl for the next step
+		if (failed!=None):
+			if (not params.adapt):
+				params.maxdispl=failed[0]
+			params.step=failed[1]
+			failed=None
 		n=n+1
 		if(params.autodamp and (n>1)):
 			params.damp = params.damp * (0.1/np.log(n))
 			if (params.damp<1.0e-5):
 				params.damp=0.0
 				params.autodamp=False
-		params.out.write('@  %3d %20.9f %9.5f %10.2e\n'%(n, E, MG, params.damp))
+		params.out.write('@  %3d %20.9f %9.5f %10.2e %8.4f %4d\n'%(n, E, MG, params.damp, steplen, params.nenergy+params.ngrad-ncalls))
+		params.priority=np.log10(max(MG,1.0e-12)/params.tolerance) #distance to convergence
+		params.endE=E
 		if (n>params.npoints):
 			keep=False
-			printTrj(params,n) #appends newGeo
+			params.termination='maxpts'
+			printTrj(params,n,MG,steplen) #appends newGeo
 			params.out.write("----------------------------------------------\n")
 			params.out.write("--          IRC CALCULATION ENDED           --\n")
 			params.out.write("--             MAXPTS ACHIEVED!             --\n")
 			params.out.write("----------------------------------------------\n")
 		elif (MG<params.tolerance):
 			keep=False
-			printTrj(params,n) #appends newGeo
+			params.termination='tolerance'
+			printTrj(params,n,MG,steplen) #appends newGeo
 			params.out.write("----------------------------------------------\n")
 			params.out.write("--          IRC CALCULATION ENDED           --\n")
 			params.out.write("--              TOL ACHIEVED!               --\n")
 			params.out.write("----------------------------------------------\n")
 		elif (E>oldE):
 			keep=False
+			params.termination='energy increased'
+			params.endE=oldE
 			#printTrj(params,n) #appends newGeo
 			params.out.write("----------------------------------------------\n")
 			params.out.write("--             ENERGY INCREASED             --\n")
@@ -518,23 +2877,245 @@ def ircdrv(inpname):
 			params.out.write("--        IRC CALCULATION TERMINATED!       --\n")
 			params.out.write("----------------------------------------------\n")
 		else:
-			printTrj(params,n) #appends newGeo
+			printTrj(params,n,MG,steplen) #appends newGeo
 			oldE=E
+		params.point=n
+		params.oldE=oldE
+		params.finished=(not keep)
+		params.WriteCheckpoint()
+	if (params.endopt and (params.termination in ('tolerance','energy increased'))):
+		try:
+			endpointOpt(params)
+		except ESSError as err:
+			params.out.write("  Endpoint optimization failed: %s\n"%(err))
+	if (params.endhess and params.finished):
+		try:
+			endpointHessian(params)
+		except ESSError as err:
+			params.out.write("  Endpoint Hessian failed: %s\n"%(err))
+	if (params.nfailed>0):
+		params.out.write("  ESS failures: %d failed attempts, %d calculations worked when tried again\n"%(params.nfailed,params.nrecovered))
+	if (params.adapt and (params.algorithm!=4)):
+		params.out.write("  Adaptive step: %d points rejected\n"%(params.nrejected))
+	if (params.backendname=='multilevel'):
+		params.out.write(params.backend.summary())
+	if (params.surrogate!=None):
+		params.out.write(params.surrogate.summary())
+
+def ircdrv(inpname,resume=False):
+	#runs the IRC in inpname (continuing from the checkpoints if resume)
+	# -> returns the ToolKit, with the ToolKits of the branches that were
+	# followed in params.branches
+	params=ToolKit(inpname)
+	printHeader(params)
+	params.branches=[params]
+	try:
+		if (params.direction==0):
+			#both directions at the same time, each with its own files
+			branches=[params.branch(1,'-f'), params.branch(-1,'-r')]
+			params.branches=branches
+			for b in branches:
+				printHeader(b)
+				if (resume):
+					b.ReadCheckpoint()
+				params.out.write("  %s branch: %s.log\n"%({1:'Forward',-1:'Reverse'}[b.direction],b.basename))
+			with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+				jobs=[pool.submit(ircbranch,b) for b in branches]
+				for j in jobs:
+					j.result()
+			for b in branches:
+				b.out.close()
+				b.CloseTrj()
+			mergeTrj(branches[1].basename+'.trj',branches[0].basename+'.trj',params.basename+'-merged.trj')
+			params.out.write("  Merged trajectory: %s-merged.trj\n"%(params.basename))
+		else:
+			if (resume):
+				params.ReadCheckpoint()
+			ircbranch(params)
+	finally:
+		#keep the last gbw of each branch, and remove everything else
+		for b in params.branches:
+			b.saveGuess()
+			b.CloseTrj()
+		if (params.scratch!=None):
+			params.scratch.cleanup()
+	if (params.cache!=None):
+		params.out.write(params.cache.summary())
+	if (params.events!=None):
+		params.out.write(params.events.summary())
+		params.events.close()
 	params.out.close()
+	return params
 
 
 
+def readManifest(fname):
+	#manifest of a batch of IRCs, in JSON or TOML:
+	# {"slots": n, "summary": "file", "runs": [{"input": "ts.inp",
+	#  "hess": "ts.hess", "modes": [6], "directions": ["+1", "-1"]}, ...]}
+	# in which "both" (as in #ircdir) may be given among the directions
+	if fname.lower().endswith('.toml'):
+		try:
+			import tomllib
+		except ImportError:
+			raise SystemExit("TOML manifests require Python 3.11 or later, please use JSON")
+		mfile=open(fname,'rb')
+		manifest=tomllib.load(mfile)
+	else:
+		mfile=open(fname,'r')
+		manifest=json.load(mfile)
+	mfile.close()
+	for run in manifest['runs']:
+		dirs=[]
+		for d in run.get('directions',['both']):
+			if (str(d).lower()=='both'):
+				dirs += [1,-1]
+			elif (str(d).strip() in ('1','+1','-1')):
+				dirs.append(int(d))
+			else:
+				raise SystemExit("Unknown direction %s in the batch manifest (use +1, -1 or both)"%(d))
+		run['directions']=dirs
+	return manifest
+
+def batchJobs(manifest):
+	#IRCs of a batch -> list of (run, mode, basename). The basename is that
+	# of the input, with -m<mode> if the run lists several modes, and with
+	# -<number of the run> (from 1) if the input is also used by other runs
+	inputs=[run['input'] for run in manifest['runs']]
+	jobs=[]
+	for i,run in enumerate(manifest['runs']):
+		modes=run.get('modes',[None])
+		for mode in modes:
+			basename='.'.join(run['input'].split('.')[:-1])
+			if (inputs.count(run['input'])>1):
+				basename += '-%d'%(i+1)
+			if (len(modes)>1):
+				basename += '-m%d'%(mode)
+			jobs.append((run,mode,basename))
+	basenames=[j[2] for j in jobs]
+	for basename in basenames:
+		if (basenames.count(basename)>1):
+			raise SystemExit("Two IRCs of the batch would write to %s.log (is a mode listed twice?)"%(basename))
+	return jobs
+
+def batchdrv(fname,resume=False):
+	#runs all the IRC branches in the manifest fname at the same time, on a
+	# shared pool of ESS slots -> returns the ToolKits of the branches
+	manifest=readManifest(fname)
+	slots=SlotPool(int(manifest.get('slots',1)))
+	jobs=batchJobs(manifest)
+	toolkits=[]
+	branches=[]
+	done=False
+	try:
+		for run,mode,basename in jobs:
+			extra=[]
+			if ('hess' in run):
+				extra.append('#irchess %s'%(run['hess']))
+			if (mode!=None):
+				extra.append('#ircmode %d'%(mode))
+			tk=ToolKit(run['input'],extra,basename)
+			tk.slots=slots
+			tk.branches=[]
+			toolkits.append(tk)
+			printHeader(tk)
+			for d in run['directions']:
+				b=tk.branch(d,{1:'-f',-1:'-r'}[d])
+				tk.branches.append(b)
+				branches.append(b)
+				printHeader(b)
+				if (resume):
+					b.ReadCheckpoint()
+				tk.out.write("  %s branch: %s.log\n"%({1:'Forward',-1:'Reverse'}[d],b.basename))
+		with concurrent.futures.ThreadPoolExecutor(max_workers=len(branches)) as pool:
+			jobs=[pool.submit(ircbranch,b) for b in branches]
+			for b,j in zip(branches,jobs):
+				try:
+					j.result()
+				except Exception as err:
+					#one failed branch does not stop the others
+					b.termination='failed'
+					b.out.write("  BRANCH FAILED: %s\n"%(err))
+		done=True
+	finally:
+		for b in branches:
+			b.saveGuess()
+			b.out.close()
+			b.CloseTrj()
+		for tk in toolkits:
+			if (tk.scratch!=None):
+				tk.scratch.cleanup()
+			if (not done):
+				#the batch could not be started (or was interrupted)
+				if (tk.events!=None):
+					tk.events.close()
+				tk.out.close()
+	for tk in toolkits:
+		dirs=[b.direction for b in tk.branches]
+		if (1 in dirs) and (-1 in dirs):
+			mergeTrj(tk.basename+'-r.trj',tk.basename+'-f.trj',tk.basename+'-merged.trj')
+			tk.out.write("  Merged trajectory: %s-merged.trj\n"%(tk.basename))
+		if (tk.cache!=None):
+			tk.out.write(tk.cache.summary())
+		if (tk.events!=None):
+			tk.out.write(tk.events.summary())
+			tk.events.close()
+		tk.out.close()
+	#endpoints and barrier heights (from the energy of the TS in the hess file)
+	summary="%-32s %5s %5s %5s %-17s %18s %10s\n"%('Branch','Mode','Dir.','Pts.','Termination','Final Energy','Barrier')
+	summary+="%-32s %5s %5s %5s %-17s %18s %10s\n"%('','','','','','(Eh)','(kcal/mol)')
+	for b in branches:
+		barrier='-'
+		if (len(b.energies)>0) and (b.point>0):
+			barrier="%10.2f"%((b.energies[0]-b.endE)*627.5095)
+		summary+="%-32s %5d %5d %5d %-17s %18.9f %10s\n"%(b.basename,b.mode,b.direction,b.point,b.termination,b.endE,barrier)
+	sname=manifest.get('summary','.'.join(fname.split('.')[:-1])+'.summary')
+	sfile=open(sname,'w')
+	sfile.write(summary)
+	sfile.close()
+	print(summary)
+	return branches
+
+def workerdrv(path):
+	#runs the jobs of the spool in path, one at a time, in a scratch
+	# directory in $TMPDIR, until path/stop exists
+	spool=Spool(path)
+	scratch=ScratchDir(tempfile.gettempdir())
+	worker="%s %d"%(socket.gethostname(),os.getpid())
+	try:
+		while not os.path.exists(os.path.join(spool.root,'stop')):
+			jobid=spool.claim(worker)
+			if (jobid==None):
+				time.sleep(spool.poll)
+				continue
+			spool.run(jobid,scratch,worker)
+	finally:
+		scratch.cleanup()
+
 if __name__=='__main__':
-	if(len(sys.argv)!=2):
+	resume=('--resume' in sys.argv[1:])
+	batch=('--batch' in sys.argv[1:])
+	work=('--worker' in sys.argv[1:])
+	args=[a for a in sys.argv[1:] if (a not in ('--resume','--batch','--worker'))]
+	if(len(args)!=1):
 		print("""IRC4Orca - Version 2.0
 An Implementation of Morokuma's IRC method for the Orca ESS Software.
 by Filipe Teixeira
 
-Usage: %s file.inp
+Usage: %s [--resume] file.inp
+       %s [--resume] --batch manifest.json
+       %s --worker spooldir
 
 Please consult https://github.com/teixeirafilipe/irc4orca for more information.
 
-"""%(sys.argv[0]))
+"""%(sys.argv[0],sys.argv[0],sys.argv[0]))
 		sys.exit(1)
-	ircdrv(sys.argv[1])
+	#so that the scratch is cleaned up when the job is killed by the queue
+	signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(128+signum))
+	if (work):
+		workerdrv(args[0])
+	elif (batch):
+		batchdrv(args[0],resume)
+	else:
+		ircdrv(args[0],resume)
 
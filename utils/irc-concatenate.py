@@ -14,22 +14,18 @@
 #                                                                        #
 # Revised 01/02/2018: Updated to Python 3.                               #
 #                                                                        #
+# Revised: frames are copied from memory-mapped files, without reading   #
+#          the trajectories into memory (see irc-trj.py).                #
+#                                                                        #
 #                                                                        #
 ##########################################################################
 
+import os
 import sys
 
-def xyzInvert(fdata):
-	nlines=int(fdata[0])+2
-	tmp=[]
-	for i in range(0,len(fdata),nlines):
-		tmp.append(fdata[i:i+nlines])
-	tmp.reverse()
-	o=[]
-	for cc in tmp:
-		for l in cc:
-			o.append(l)
-	return o
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(here))
+import irc4orca
 
 if (__name__=='__main__'):
 	try:
@@ -39,23 +35,4 @@ if (__name__=='__main__'):
 	except:
 		print('Usage: irc-concatenate.py forward.trj backward.trj out.trj')
 		sys.exit(1)
-	ffile=open(fn1,'r')
-	bfile=open(fn2,'r')
-	ffdata=ffile.readlines()
-	bbdata=bfile.readlines()
-	ffile.close()
-	bfile.close()
-	nbdata=xyzInvert(bbdata)
-	of=open(fn3,'w')
-	for line in nbdata:
-		of.write(line)
-	for line in ffdata:
-		of.write(line)
-	of.close()
-
-
-	
-
-
-
-
+	irc4orca.mergeTrj(fn2,fn1,fn3)
@@ -0,0 +1,112 @@
+#! /usr/bin/env python3
+# -*- coding: utf8 -*-
+
+##########################################################################
+#                                                                        #
+# Program: irc-trj.py                                                    #
+#                                                                        #
+# Usage: irc-trj.py info file.trj                                        #
+#        irc-trj.py energies file.trj                                    #
+#        irc-trj.py reverse in.trj out.trj                               #
+#        irc-trj.py stride n in.trj out.trj                              #
+#        irc-trj.py cat in1.trj in2.trj [...] out.trj                    #
+#        irc-trj.py merge reverse.trj forward.trj [...] out.trj          #
+#        irc-trj.py xyz file.trj.npy out.trj                             #
+#                                                                        #
+# Works on the trajectories written by IRC4Orca (or any xyz file with    #
+# several frames) without loading them into memory: the frames are       #
+# indexed by their byte offsets and copied as they are. info and         #
+# energies also read the binary trajectories (basename.trj.npy, see      #
+# #ircbintrj), which are loaded as memory maps.                          #
+#                                                                        #
+#   info     - number of frames and atoms, and the first and last energy #
+#   energies - point number, energy (from the E= in the comment lines)   #
+#              and energy relative to the first frame (kcal/mol)         #
+#   reverse  - writes the frames in reverse order                        #
+#   stride   - writes every n-th frame (and always the last one)         #
+#   cat      - writes the frames of all inputs, one after the other      #
+#   merge    - writes the first trajectory backwards, followed by the    #
+#              others (e.g., the reverse and forward branches of an IRC) #
+#   xyz      - writes a binary trajectory as an xyz trajectory           #
+#                                                                        #
+##########################################################################
+
+import os
+import sys
+import numpy as np
+
+here=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.dirname(here))
+import irc4orca
+
+def usage():
+	print("""Usage: irc-trj.py info file.trj
+       irc-trj.py energies file.trj
+       irc-trj.py reverse in.trj out.trj
+       irc-trj.py stride n in.trj out.trj
+       irc-trj.py cat in1.trj in2.trj [...] out.trj
+       irc-trj.py merge reverse.trj forward.trj [...] out.trj
+       irc-trj.py xyz file.trj.npy out.trj""")
+	sys.exit(1)
+
+def copyFrames(inputs,ofn):
+	#inputs: list of (file name, function of the number of frames -> indices)
+	out=irc4orca.TrjWriter(ofn,'w')
+	for fname,frames in inputs:
+		trj=irc4orca.TrjReader(fname)
+		out.copy(trj,frames(len(trj)))
+		trj.close()
+	out.close()
+
+def isBinary(fname):
+	return fname.lower().endswith('.npy')
+
+if (__name__=='__main__'):
+	if (len(sys.argv)<3):
+		usage()
+	cmd=sys.argv[1]
+	args=sys.argv[2:]
+	if (cmd=='info') and (len(args)==1) and isBinary(args[0]):
+		trj=np.load(args[0],mmap_mode='r')
+		print("%s: %d points"%(args[0],len(trj)))
+		if (len(trj)>0):
+			print("  atoms: %d"%(len(trj[0]['symbols'])))
+			for label,i in (('first',0),('last',-1)):
+				print("  %-6s point %d E=%14.7f RMS Grad.=%9.5f Step=%8.4f"%(label+':',trj[i]['point'],trj[i]['energy'],trj[i]['rms'],trj[i]['step']))
+	elif (cmd=='energies') and (len(args)==1) and isBinary(args[0]):
+		trj=np.load(args[0],mmap_mode='r')
+		energies=trj['energy']
+		for i in range(len(energies)):
+			print("%5d %16.7f %10.3f"%(trj[i]['point'],energies[i],(energies[i]-energies[0])*627.5095))
+	elif (cmd=='xyz') and (len(args)==2):
+		trj=np.load(args[0],mmap_mode='r')
+		out=irc4orca.TrjWriter(args[1],'w')
+		for rec in trj:
+			geo=irc4orca.Geometry(tuple(rec['symbols']),rec['coords'])
+			out.write(geo,"IRC for Orca point %d E=%14.7f"%(rec['point'],rec['energy']))
+		out.close()
+	elif (cmd=='info') and (len(args)==1):
+		trj=irc4orca.TrjReader(args[0])
+		print("%s: %d frames"%(args[0],len(trj)))
+		if (len(trj)>0):
+			print("  atoms: %d"%(len(trj.geometry(0))))
+			print("  first: %s"%(trj.comment(0).strip()))
+			print("  last:  %s"%(trj.comment(-1).strip()))
+		trj.close()
+	elif (cmd=='energies') and (len(args)==1):
+		trj=irc4orca.TrjReader(args[0])
+		energies=trj.energies()
+		for i in range(len(energies)):
+			print("%5d %16.7f %10.3f"%(i+1,energies[i],(energies[i]-energies[0])*627.5095))
+		trj.close()
+	elif (cmd=='reverse') and (len(args)==2):
+		copyFrames([(args[0],lambda n: range(n-1,-1,-1))],args[1])
+	elif (cmd=='stride') and (len(args)==3):
+		step=int(args[0])
+		copyFrames([(args[1],lambda n: sorted(set(list(range(0,n,step))+[n-1]) if n>0 else []))],args[2])
+	elif (cmd=='cat') and (len(args)>=2):
+		copyFrames([(f,lambda n: range(n)) for f in args[:-1]],args[-1])
+	elif (cmd=='merge') and (len(args)>=3):
+		copyFrames([(args[0],lambda n: range(n-1,-1,-1))]+[(f,lambda n: range(n)) for f in args[1:-1]],args[-1])
+	else:
+		usage()